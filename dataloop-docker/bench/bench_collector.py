@@ -0,0 +1,167 @@
+"""Time the dataloop-docker metrics collection against fake host filesystems.
+
+For each number of containers, a fake rootfs is generated (see fake_rootfs.py) and
+a child process runs a warm up cycle followed by the timed collection cycles. The
+collector never sleeps, only the cycles themselves are timed. It reports the wall
+time per cycle, the files opened and read syscalls per cycle, and the peak RSS.
+"""
+import __builtin__
+import getopt
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_rootfs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../root/opt/dataloop/embedded/bin"))
+
+from utils import docker_stats  # noqa: E402
+
+
+class SyscallCounter(object):
+    """Count the files opened and the read syscalls made through python."""
+
+    def __init__(self):
+        self.counts = {"open": 0, "read": 0}
+        self.builtin_open = __builtin__.open
+        self.os_open = os.open
+        self.os_read = os.read
+
+    def install(self):
+        __builtin__.open = self._counted(self.builtin_open, "open")
+        os.open = self._counted(self.os_open, "open")
+        os.read = self._counted(self.os_read, "read")
+
+    def reset(self):
+        self.counts = dict.fromkeys(self.counts, 0)
+
+    def _counted(self, function, name):
+        def counted(*args, **kwargs):
+            self.counts[name] += 1
+            return function(*args, **kwargs)
+        return counted
+
+
+def run_cycles(rootfs, containers, cycles, workers):
+    """Run in the child process, return the results of the timed cycles."""
+    collector = docker_stats.Collector(rootfs, workers)
+    counter = SyscallCounter()
+    counter.install()
+
+    def list_containers():
+        return [{
+            "id": fake_rootfs.container_id(i),
+            "finger": "finger-%d" % i,
+            "pid": fake_rootfs.container_pid(i),
+        } for i in xrange(containers)]
+
+    def run_cycle():
+        listed = list_containers()
+        metrics = collector.collect(listed)
+        collector.prune([(c["id"], c["pid"]) for c in listed])
+        return metrics
+
+    # first cycle: cgroups discovery and no rates yet
+    run_cycle()
+    counter.reset()
+
+    started = time.time()
+    for _ in xrange(cycles):
+        metrics = run_cycle()
+    elapsed = time.time() - started
+
+    return {
+        "containers": containers,
+        "metrics": len(metrics),
+        "cycle_ms": elapsed / cycles * 1000,
+        "opened_per_cycle": float(counter.counts["open"]) / cycles,
+        "reads_per_cycle": float(counter.counts["read"]) / cycles,
+        # ru_maxrss is in kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def bench(sizes, cycles, workers, unified):
+    results = []
+
+    for containers in sizes:
+        rootfs = tempfile.mkdtemp(prefix="dataloop-bench-")
+        try:
+            fake_rootfs.generate(os.path.join(rootfs, "rootfs"), containers, unified)
+
+            # a fresh process per size, so the peak RSS isn't the one of the largest run so far
+            cmd = [sys.executable, os.path.abspath(__file__), "--child", "-c", str(cycles),
+                   "-w", str(workers), os.path.join(rootfs, "rootfs"), str(containers)]
+            results.append(json.loads(subprocess.check_output(cmd)))
+
+        finally:
+            shutil.rmtree(rootfs)
+
+    return results
+
+
+def print_results(results):
+    print "%10s %10s %12s %12s %12s %12s" % ("containers", "metrics", "cycle (ms)", "opened", "reads",
+                                             "peak rss mb")
+    for r in results:
+        print "%10d %10d %12.1f %12.1f %12.1f %12.1f" % (r["containers"], r["metrics"], r["cycle_ms"],
+                                                         r["opened_per_cycle"], r["reads_per_cycle"],
+                                                         r["peak_rss_mb"])
+
+
+def main(argv):
+    sizes = [10, 100, 1000]
+    cycles = 5
+    workers = 1
+    unified = False
+    child = False
+
+    try:
+        opts, args = getopt.getopt(argv, "hn:c:w:u", ["help", "containers=", "cycles=", "workers=",
+                                                      "unified", "child"])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif opt in ("-n", "--containers"):
+            sizes = [int(n) for n in arg.split(",")]
+        elif opt in ("-c", "--cycles"):
+            cycles = int(arg)
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt in ("-u", "--unified"):
+            unified = True
+        elif opt == "--child":
+            child = True
+
+    if child:
+        rootfs, containers = args
+        print json.dumps(run_cycles(rootfs, int(containers), cycles, workers))
+        return
+
+    print_results(bench(sizes, cycles, workers, unified))
+
+
+def usage():
+    usage = """bench_collector.py
+    -h --help                       Prints this
+    -n --containers <n,n,...>       Numbers of containers to bench (default to "10,100,1000")
+    -c --cycles <cycles>            Timed collection cycles per run (default to "5")
+    -w --workers <workers>          Collector workers (default to "1")
+    -u --unified                    Use the cgroup v2 unified hierarchy instead of cgroup v1
+    """
+    print usage
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,146 @@
+"""Check the number of api requests per agents sync against a local stub server.
+
+The stub server records every request. With bulk requests, pinging, tagging and
+deregistering N agents must take a constant number of requests, whatever N. When the
+server rejects the bulk route, every agent must still be sent, one request each. When
+it only fails the bulk requests, ex: 429, they are retried but never sent one by one.
+Exits with 1 if any check fails.
+"""
+import BaseHTTPServer
+import SocketServer
+import getopt
+import logging
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../root/opt/dataloop/embedded/bin"))
+
+from utils import api, http_client  # noqa: E402
+
+
+class StubServer(object):
+    """Record the requests and answer 200, or `bulk_status` to the bulk ones."""
+
+    def __init__(self, bulk_status):
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                stub.requests.append((self.command, self.path))
+
+                status = bulk_status if self.path.startswith("/bulk/") else 200
+                self.send_response(status)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write("[]")
+
+            do_GET = do_POST = do_PUT = _respond
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_url(self):
+        return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def sync(ctx, agents):
+    """The api calls of an agents sync, return whether every agent was sent."""
+    fingers = [agent["finger"] for agent in agents]
+    results = api.ping_agents(ctx, agents)
+    results += api.tag_agents(ctx, [{"finger": finger, "tags": "all,docker"} for finger in fingers])
+    results += api.deregister_agents(ctx, fingers)
+    return all(results) and len(results) == 3 * len(agents)
+
+
+def count_requests(agents_count, batch_size, bulk_status):
+    server = StubServer(bulk_status)
+    ctx = {
+        "api_host": server.get_url(),
+        "api_key": "key",
+        "api_batch_size": batch_size,
+    }
+    agents = [{"finger": "finger-%d" % i, "name": "agent-%d" % i} for i in xrange(agents_count)]
+
+    try:
+        sent = sync(ctx, agents)
+        return sent, len(server.requests)
+    finally:
+        server.stop()
+
+
+def main(argv):
+    sizes = [10, 100, 1000]
+    batch_size = 500
+
+    try:
+        opts, args = getopt.getopt(argv, "hn:b:", ["help", "agents=", "batch-size="])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif opt in ("-n", "--agents"):
+            sizes = [int(n) for n in arg.split(",")]
+        elif opt in ("-b", "--batch-size"):
+            batch_size = int(arg)
+
+    logging.basicConfig(level=logging.ERROR)
+
+    failed = False
+    print "%10s %12s %10s %10s" % ("agents", "bulk status", "requests", "expected")
+
+    for agents_count in sizes:
+        chunks = -(-agents_count // batch_size)
+        checks = [
+            # supported: one request per chunk and endpoint
+            (200, 3 * chunks, True),
+            # rejected: the bulk attempt, then one request per agent and endpoint
+            (404, 3 * chunks + 3 * agents_count, True),
+            (400, 3 * chunks + 3 * agents_count, True),
+            # failed: the bulk requests are retried, the agents aren't sent one by one
+            (429, 3 * chunks * (http_client.RETRIES + 1), False),
+            (403, 3 * chunks, False),
+        ]
+
+        for bulk_status, expected, expected_sent in checks:
+            sent, requests = count_requests(agents_count, batch_size, bulk_status)
+            ok = sent == expected_sent and requests == expected
+            failed = failed or not ok
+            print "%10d %12d %10d %10d %s" % (agents_count, bulk_status, requests, expected, "" if ok else "FAILED")
+
+    sys.exit(1 if failed else 0)
+
+
+def usage():
+    usage = """check_api_bulk.py
+    -h --help                       Prints this
+    -n --agents <n,n,...>           Numbers of agents to sync (default to "10,100,1000")
+    -b --batch-size <n>             Maximum number of agents per bulk request (default to "500")
+    """
+    print usage
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,189 @@
+"""Generate a fake host filesystem for the dataloop-docker metrics collection.
+
+It contains the files read by utils/cgroups_util.py for N containers:
+proc/mounts, proc/stat, proc/meminfo, proc/<pid>/cgroup, proc/<pid>/net/dev
+and the cgroup v1 (memory, cpu,cpuacct, blkio) or v2 (unified) directories.
+"""
+import getopt
+import os
+import random
+import sys
+
+FIRST_PID = 1000
+CPUS = 8
+
+cgroup_v1_subsystems = ["memory", "cpu,cpuacct", "blkio"]
+
+memory_stat_keys = [
+    "cache", "rss", "rss_huge", "mapped_file", "dirty", "writeback", "swap", "pgpgin", "pgpgout",
+    "pgfault", "pgmajfault", "inactive_anon", "active_anon", "inactive_file", "active_file",
+    "unevictable", "hierarchical_memory_limit", "hierarchical_memsw_limit",
+]
+
+unified_memory_stat_keys = [
+    "anon", "file", "kernel_stack", "sock", "shmem", "file_mapped", "file_dirty", "file_writeback",
+    "inactive_anon", "active_anon", "inactive_file", "active_file", "unevictable", "pgfault", "pgmajfault",
+]
+
+
+def container_id(index):
+    return "%064x" % (index + 1)
+
+
+def container_pid(index):
+    return FIRST_PID + index
+
+
+def generate(rootfs, containers, unified=False):
+    """Write the fake host files for `containers` containers in rootfs."""
+    rootfs = os.path.abspath(rootfs)
+
+    _write_mounts(rootfs, unified)
+    _write_host_files(rootfs)
+
+    for index in xrange(containers):
+        pid = container_pid(index)
+        cid = container_id(index)
+
+        _write_net_dev(rootfs, pid)
+        if unified:
+            _write_unified_cgroup(rootfs, pid, cid)
+        else:
+            _write_cgroup(rootfs, pid, cid)
+
+
+def _write(rootfs, path, content):
+    path = os.path.join(rootfs, path)
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(path, "w") as fp:
+        fp.write(content)
+
+
+def _write_mounts(rootfs, unified):
+    if unified:
+        mountpoint = os.path.join(rootfs, "sys/fs/cgroup")
+        mounts = "cgroup2 %s cgroup2 rw,nosuid,nodev,noexec,relatime 0 0\n" % mountpoint
+        os.makedirs(mountpoint)
+    else:
+        mounts = ""
+        for subsystem in cgroup_v1_subsystems:
+            mountpoint = os.path.join(rootfs, "sys/fs/cgroup", subsystem)
+            mounts += "cgroup %s cgroup rw,nosuid,nodev,noexec,relatime,%s 0 0\n" % (mountpoint, subsystem)
+            os.makedirs(mountpoint)
+
+    _write(rootfs, "proc/mounts", "proc /proc proc rw,nosuid,nodev,noexec,relatime 0 0\n" + mounts)
+
+
+def _write_host_files(rootfs):
+    cpu_line = "cpu%s 4705 356 584 3699 23 23 0 0 0 0\n"
+    stat = cpu_line % " " + "".join(cpu_line % i for i in xrange(CPUS))
+    stat += "intr 1462898\nctxt 2104567\nbtime 1493287845\nprocesses 6032\n"
+    _write(rootfs, "proc/stat", stat)
+
+    _write(rootfs, "proc/meminfo", "MemTotal:       16307524 kB\nMemFree:         6284884 kB\n"
+                                   "MemAvailable:   11893556 kB\nSwapTotal:       2097148 kB\n"
+                                   "SwapFree:        2097148 kB\n")
+
+
+def _write_net_dev(rootfs, pid):
+    net_line = "%6s: %d 1240 0 0 0 0 0 0 %d 1100 0 0 0 0 0 0\n"
+    net_dev = ("Inter-|   Receive                                                |  Transmit\n"
+               " face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets "
+               "errs drop fifo colls carrier compressed\n")
+    net_dev += net_line % ("lo", 0, 0)
+    net_dev += net_line % ("eth0", random.randint(1, 10 ** 9), random.randint(1, 10 ** 9))
+
+    _write(rootfs, "proc/%d/net/dev" % pid, net_dev)
+    _write(rootfs, "proc/%d/comm" % pid, "python\n")
+    _write(rootfs, "proc/%d/cmdline" % pid, "python\0app.py\0")
+
+
+def _write_cgroup(rootfs, pid, cid):
+    cgroup_path = "/docker/%s" % cid
+    _write(rootfs, "proc/%d/cgroup" % pid,
+           "".join("%d:%s:%s\n" % (i + 2, s, cgroup_path) for i, s in enumerate(cgroup_v1_subsystems)) +
+           "1:name=systemd:%s\n" % cgroup_path)
+
+    for subsystem in cgroup_v1_subsystems:
+        _write(rootfs, "sys/fs/cgroup/%s%s/cgroup.procs" % (subsystem, cgroup_path), "%d\n" % pid)
+
+    memory_path = "sys/fs/cgroup/memory%s/" % cgroup_path
+    memory_stat = "".join("%s %d\n" % (k, random.randint(0, 10 ** 8)) for k in memory_stat_keys[:-2])
+    memory_stat += "hierarchical_memory_limit 9223372036854771712\n"
+    memory_stat += "hierarchical_memsw_limit 9223372036854771712\n"
+    _write(rootfs, memory_path + "memory.stat", memory_stat)
+
+    cpu_path = "sys/fs/cgroup/cpu,cpuacct%s/" % cgroup_path
+    _write(rootfs, cpu_path + "cpuacct.usage", "%d\n" % random.randint(0, 10 ** 12))
+    _write(rootfs, cpu_path + "cpuacct.usage_percpu",
+           " ".join(str(random.randint(0, 10 ** 11)) for _ in xrange(CPUS)) + " \n")
+    _write(rootfs, cpu_path + "cpuacct.stat", "user 2345\nsystem 1234\n")
+
+    blkio_path = "sys/fs/cgroup/blkio%s/" % cgroup_path
+    for file_name in ["blkio.throttle.io_serviced", "blkio.throttle.io_service_bytes"]:
+        lines = "".join("8:0 %s %d\n" % (op, random.randint(0, 10 ** 6))
+                        for op in ["Read", "Write", "Sync", "Async", "Total"])
+        _write(rootfs, blkio_path + file_name, lines + "Total 0\n")
+
+
+def _write_unified_cgroup(rootfs, pid, cid):
+    cgroup_path = "/system.slice/docker-%s.scope" % cid
+    _write(rootfs, "proc/%d/cgroup" % pid, "0::%s\n" % cgroup_path)
+
+    path = "sys/fs/cgroup%s/" % cgroup_path
+    _write(rootfs, path + "cgroup.procs", "%d\n" % pid)
+    _write(rootfs, path + "cpu.stat", "usage_usec %d\nuser_usec 2345000\nsystem_usec 1234000\n"
+                                      "nr_periods 0\nnr_throttled 0\nthrottled_usec 0\n"
+           % random.randint(0, 10 ** 9))
+    _write(rootfs, path + "memory.stat",
+           "".join("%s %d\n" % (k, random.randint(0, 10 ** 8)) for k in unified_memory_stat_keys))
+    _write(rootfs, path + "memory.current", "%d\n" % random.randint(10 ** 8, 10 ** 9))
+    _write(rootfs, path + "memory.max", "max\n")
+    _write(rootfs, path + "memory.swap.current", "0\n")
+    _write(rootfs, path + "memory.swap.max", "max\n")
+    _write(rootfs, path + "io.stat", "8:0 rbytes=%d wbytes=%d rios=192 wios=353 dbytes=0 dios=0\n"
+           % (random.randint(0, 10 ** 9), random.randint(0, 10 ** 9)))
+
+
+def main(argv):
+    containers = 10
+    unified = False
+
+    try:
+        opts, args = getopt.getopt(argv, "hn:u", ["help", "containers=", "unified"])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif opt in ("-n", "--containers"):
+            containers = int(arg)
+        elif opt in ("-u", "--unified"):
+            unified = True
+
+    if len(args) != 1 or os.path.exists(args[0]):
+        usage()
+        sys.exit(2)
+
+    generate(args[0], containers, unified)
+
+
+def usage():
+    usage = """fake_rootfs.py [options] <path>
+    -h --help                       Prints this
+    -n --containers <containers>    Number of containers (default to "10")
+    -u --unified                    Use the cgroup v2 unified hierarchy instead of cgroup v1
+    """
+    print usage
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
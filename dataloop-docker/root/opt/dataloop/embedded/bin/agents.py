@@ -1,11 +1,13 @@
 import getopt
+import hashlib
+import json
 import logging
 import sys
 import time
 import os
-import requests
 
-from utils import api, docker_util, logger_util
+from utils import api, docker_util, host_facts, instruments, inventory, logger_util, metadata, proc_util, registry
+from utils import scheduler
 
 logger = logging.getLogger('AGENTS')
 
@@ -16,40 +18,47 @@ loopback_interface = {
     'addresses': [{'ips': ['127.0.0.1'], 'family': 'AF_INET'}]
 }
 
+# what is left of the agent payload in a ping when nothing changed since the last one
+keepalive_keys = ['finger', 'name', 'mac', 'container_id', 'parent']
+
 
 def sync(ctx):
     logger.info("agents sync")
 
     try:
-        containers = docker_util.list_containers()
-        ctx['host_finger'] = get_host_finger()
-        ctx['system_uuid'] = docker_util.get_system_uuid() or ctx['host_finger']
+        with ctx['instruments'].timer("agents.list_containers"):
+            containers = ctx['inventory'].list_containers()
+
+        ctx['processes'].refresh([(c.id, docker_util.get_pid(c)) for c in containers])
+        ctx['metadata'].prune([c.id for c in containers])
+        ctx['host_finger'] = ctx['host_facts'].get(host_facts.HOST_FINGER)
+        ctx['system_uuid'] = ctx['host_facts'].get(host_facts.SYSTEM_UUID) or ctx['host_finger']
+        ctx['host_hostname'] = ctx['host_facts'].get(host_facts.HOSTNAME, "")
 
         ping_containers(ctx, containers)
         tag_containers(ctx, containers)
         deregister_dead_containers(ctx, containers)
+        ctx['instruments'].incr("agents.containers", len(containers))
+
+        logger.debug("api requests: %s" % api.get_stats(ctx))
 
     except Exception as ex:
         logger.error("agent sync failed: %s" % ex, exc_info=True)
-
-
-def get_host_finger():
-    finger = requests.get("http://localhost:8000").text
-    # this endpoint returns the fingerprint with a newline, so strip whitespace
-    return finger.strip()
+        ctx['instruments'].incr("agents.errors")
 
 
 def ping_containers(ctx, containers):
 
     def create_agent(container):
+        container_metadata = ctx['metadata'].get(container)
         return {
-            'finger': docker_util.get_hash(container),
+            'finger': container_metadata['finger'],
             'name': container.name,
             'mac': ctx['system_uuid'],
-            'hostname': docker_util.get_container_hostname(container),
+            'hostname': container_metadata['hostname'],
             'os_name': 'docker',
             'os_version': '',
-            'processes': docker_util.get_processes(container),
+            'processes': _get_processes(ctx, container),
             'interfaces': _get_agent_interface(container),
             'mode': 'DEFAULT',
             'interpreter': '/usr/bin/python',
@@ -58,28 +67,125 @@ def ping_containers(ctx, containers):
         }
 
     agents = map(create_agent, containers)
-    api.ping_agents(ctx, agents)
+    changed, unchanged = _find_changed(ctx, ctx['sent_pings'], agents)
+
+    keepalives = [dict((k, agent[k]) for k in keepalive_keys) for agent in unchanged]
+    logger.debug("pinging %d changed and %d unchanged agents" % (len(changed), len(keepalives)))
+
+    pinged = [agent for agent, _ in changed] + keepalives
+    results = _call_api(ctx, "ping", api.ping_agents, pinged)
+    _remember_sent(ctx['sent_pings'], agents, changed, results[:len(changed)])
+
+    # a ping registers the agent
+    ctx['registry'].add([agent['finger'] for agent, succeeded in zip(pinged, results) if succeeded])
 
 
 def tag_containers(ctx, containers):
 
     def create_tags(container):
         return {
-            'finger': docker_util.get_hash(container),
-            'tags': _get_agent_tags(ctx, container)
+            'finger': ctx['metadata'].get_finger(container),
+            'tags': ctx['metadata'].get_tags(container, ctx['host_finger'], ctx['host_hostname'])
         }
 
     agents = map(create_tags, containers)
-    api.tag_agents(ctx, agents)
+    changed, _ = _find_changed(ctx, ctx['sent_tags'], agents)
+
+    results = _call_api(ctx, "tags", api.tag_agents, [agent for agent, _ in changed])
+    _remember_sent(ctx['sent_tags'], agents, changed, results)
 
 
 def deregister_dead_containers(ctx, containers):
-    agents = api.list_agents(ctx, ctx['system_uuid'])
-    agent_ids = set(map(lambda a: a['id'], agents))
+    """Deregister the agents in the local registry whose container is gone.
+
+    Every `reconcile_interval` seconds the agents registered on the server for this host are
+    listed too, to catch the ones the registry doesn't know about.
+    """
+    container_hashes = set(map(ctx['metadata'].get_finger, containers))
+    _deregister(ctx, list(ctx['registry'].fingers() - container_hashes))
+
+    if time.time() - ctx['last_reconcile'] >= ctx['reconcile_interval']:
+        # retried at the next interval, not at every sync, when the api is down
+        ctx['last_reconcile'] = time.time()
+        try:
+            agents = _call_api(ctx, "list", api.list_agents, ctx['system_uuid'])
+        except Exception as ex:
+            logger.error("agents reconcile failed: %s" % ex)
+            return
+
+        agent_ids = set(map(lambda a: a['id'], agents))
+        ctx['registry'].add(agent_ids & container_hashes)
+        _deregister(ctx, list(agent_ids - container_hashes - ctx['registry'].fingers()))
+
+
+def _deregister(ctx, fingers):
+    results = _call_api(ctx, "deregister", api.deregister_agents, fingers)
+    ctx['registry'].remove([finger for finger, succeeded in zip(fingers, results) if succeeded])
 
-    container_hashes = docker_util.get_container_hashes(containers)
-    dead_containers = agent_ids - container_hashes
-    api.deregister_agents(ctx, dead_containers)
+
+def _call_api(ctx, name, call, items):
+    """Time an api call, and count the agents it failed for."""
+    with ctx['instruments'].timer("agents.api.%s" % name):
+        try:
+            results = call(ctx, items)
+        except Exception:
+            ctx['instruments'].incr("agents.api.%s.errors" % name)
+            raise
+
+    ctx['instruments'].incr("agents.api.%s.errors" % name, results.count(False))
+    return results
+
+
+def _find_changed(ctx, sent, payloads):
+    """Split the payloads between the ones which changed since they were last sent and the others.
+
+    sent is {finger: (content hash, time sent)}, a payload is sent again in full at least every
+    `full_sync_interval` seconds in case the server lost it. Changed payloads come with their hash.
+    """
+    changed, unchanged = [], []
+    now = time.time()
+
+    for payload in payloads:
+        payload_hash = _hash_payload(payload)
+        last_hash, sent_at = sent.get(payload['finger'], (None, 0))
+
+        if payload_hash != last_hash or now - sent_at > ctx['full_sync_interval']:
+            changed.append((payload, payload_hash))
+        else:
+            unchanged.append(payload)
+
+    return changed, unchanged
+
+
+def _remember_sent(sent, payloads, changed, results):
+    """Remember the changed payloads which were sent, forget the containers which are gone.
+
+    results are the api call successes, in the same order as changed.
+    """
+    now = time.time()
+
+    for (payload, payload_hash), succeeded in zip(changed, results):
+        if succeeded:
+            sent[payload['finger']] = (payload_hash, now)
+
+    fingers = set(payload['finger'] for payload in payloads)
+    for finger in sent.keys():
+        if finger not in fingers:
+            del sent[finger]
+
+
+def _hash_payload(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True)).hexdigest()
+
+
+def _get_processes(ctx, container):
+    processes = ctx['processes'].get_processes(container.id)
+
+    # the host pids aren't visible from here, ask docker instead
+    if processes is None:
+        processes = docker_util.get_processes(container)
+
+    return processes
 
 
 def _get_agent_interface(container):
@@ -96,36 +202,83 @@ def _get_agent_interface(container):
     return interfaces
 
 
-def _get_agent_tags(ctx, container):
-    tags = ["all", "docker"]
-
-    tags.append("container:%s" % docker_util.get_container_hostname(container))
-    tags.append("parent:%s" % ctx['host_finger'])
-    tags.append(docker_util.get_image(container))
-    tags.append(docker_util.get_host_hostname())
-    tags.append(docker_util.get_container_hostname(container))
-    tags += _get_agent_env_vars(container)
-    tags += docker_util.get_labels(container)
-
-    sanitized = [t.replace('/', ':') for t in set(filter(None, tags))]
-    return ','.join(sanitized)
+def setup(ctx):
+    """Create what the agents sync needs, the inventory and metadata already in ctx are shared."""
+    ctx['sent_pings'] = {}
+    ctx['sent_tags'] = {}
+    ctx['last_reconcile'] = 0
+    ctx['registry'] = registry.AgentRegistry(ctx['registry_path'])
+    ctx['processes'] = proc_util.ProcessInventory(ctx['rootfs'])
+
+    if 'instruments' not in ctx:
+        ctx['instruments'] = instruments.Instruments()
+
+    if 'host_facts' not in ctx:
+        ctx['host_facts'] = host_facts.HostFacts()
+        ctx['host_facts'].start()
+
+    if 'metadata' not in ctx:
+        ctx['metadata'] = metadata.MetadataCache()
+
+    if 'inventory' not in ctx:
+        ctx['inventory'] = inventory.ContainerInventory()
+        ctx['inventory'].start()
+
+
+def parse_opt(ctx, opt, arg):
+    """Apply an agents option to ctx, return False when it isn't one."""
+    if opt in ("-a", "--apikey"):
+        ctx['api_key'] = arg
+    elif opt in ("-u", "--apiurl"):
+        ctx['api_host'] = arg
+    elif opt in ("-c", "--concurrency"):
+        ctx['api_concurrency'] = int(arg)
+    elif opt in ("-b", "--batch-size"):
+        ctx['api_batch_size'] = int(arg)
+    elif opt in ("-g", "--registry"):
+        ctx['registry_path'] = arg
+    elif opt in ("-i", "--reconcile-interval"):
+        ctx['reconcile_interval'] = int(arg)
+    else:
+        return False
+
+    return True
+
+
+defaults = {
+    "sync_interval": 10,
+    "full_sync_interval": 300,
+    "reconcile_interval": 600,
+    "registry_path": registry.REGISTRY_PATH,
+    "api_host": "https://agent.dataloop.io",
+    "api_key": None,
+    "api_concurrency": 10,
+    "api_batch_size": api.BATCH_SIZE,
+}
 
+short_opts = "a:u:c:b:g:i:"
+long_opts = ["apikey=", "apiurl=", "concurrency=", "batch-size=", "registry=", "reconcile-interval="]
 
-def _get_agent_env_vars(container):
-    container_env_vars = docker_util.get_env_variables(container)
-    return [container_env_vars[key] for key in container_env_vars if key in ['ENV', 'APP_NAME']]
+opts_usage = """    -a --apikey <apikey>                    Your dataloop api key
+    -u --apiurl <apiurl>                    The dataloop api url (default to "https://agent.dataloop.io")
+    -c --concurrency <n>                    Maximum number of concurrent api requests (default to "10")
+    -b --batch-size <n>                     Maximum number of agents per bulk api request, 0 to disable (default to "0")
+    -g --registry <path>                    Where the registered agents are persisted (default to "/opt/dataloop/agents.json")
+    -i --reconcile-interval <s>             Seconds between checks of the agents registered on the server (default to "600")
+"""
 
 
 def main(argv):
     ctx = {
-        "sync_interval": 10,
-        "api_host": "https://agent.dataloop.io",
-        "api_key": None,
+        "rootfs": "/rootfs",
         "debug": False,
+        "profile": 0,
     }
+    ctx.update(defaults)
 
     try:
-        opts, args = getopt.getopt(argv, "ha:u:d", ["help", "apikey=", "apiurl=", "debug"])
+        opts, args = getopt.getopt(argv, "h" + short_opts + "r:d",
+                                   ["help"] + long_opts + ["rootfs=", "debug", "profile="])
     except getopt.GetoptError, err:
         print str(err)
         usage()
@@ -135,30 +288,33 @@ def main(argv):
         if opt in ("-h", "--help"):
             usage()
             sys.exit(2)
-        elif opt in ("-a", "--apikey"):
-            ctx['api_key'] = arg
-        elif opt in ("-u", "--apiurl"):
-            ctx['api_host'] = arg
+        elif opt in ("-r", "--rootfs"):
+            ctx['rootfs'] = arg
         elif opt in ("-d", "--debug"):
             ctx["debug"] = True
+        elif opt == "--profile":
+            ctx['profile'] = int(arg)
+        else:
+            parse_opt(ctx, opt, arg)
 
     if ctx['api_key'] is None:
         usage()
         sys.exit(2)
 
     logger_util.setup_logger(ctx)
+    setup(ctx)
 
-    while True:
-        sync(ctx)
-        time.sleep(ctx['sync_interval'])
+    tasks = scheduler.Scheduler(ctx['instruments'], ctx['profile'])
+    tasks.add("agents", ctx['sync_interval'], sync, ctx)
+    tasks.run()
 
 
 def usage():
     usage = """agents.py
-    -h --help                   Prints this
-    -a --apikey <apikey>        Your dataloop api key
-    -u --apiurl <apiurl>        The dataloop api url (default to "https://agent.dataloop.io")
-    -d --debug                  Change log level to DEBUG, default to INFO
+    -h --help                               Prints this
+""" + opts_usage + """    -r --rootfs <rootfs>                    Where the host filesystem is mounted (default to "/rootfs")
+    -d --debug                              Change log level to DEBUG, default to INFO
+    --profile <cycles>                      Profile the first cycles, the stats are written to /tmp
     """
     print usage
 
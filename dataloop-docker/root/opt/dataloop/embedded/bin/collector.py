@@ -0,0 +1,81 @@
+import getopt
+import logging
+import sys
+import os
+
+import agents
+import metrics
+from utils import logger_util, scheduler
+
+logger = logging.getLogger('COLLECTOR')
+
+os.environ['NO_PROXY'] = '127.0.0.1'
+
+
+def main(argv):
+    """Run the agents sync and the metrics collection from one process.
+
+    Both share the container inventory, the containers metadata, the host facts, the
+    instruments and the docker client. The agents sync has its own thread, the api calls
+    must not delay the metrics ticks.
+    """
+    ctx = {
+        "rootfs": "/rootfs",
+        "debug": False,
+        "profile": 0,
+    }
+    ctx.update(agents.defaults)
+    ctx.update(metrics.defaults)
+
+    try:
+        opts, args = getopt.getopt(argv, "h" + agents.short_opts + metrics.short_opts + "r:d",
+                                   ["help"] + agents.long_opts + metrics.long_opts + ["rootfs=", "debug", "profile="])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif opt in ("-r", "--rootfs"):
+            ctx['rootfs'] = arg
+        elif opt in ("-d", "--debug"):
+            ctx["debug"] = True
+        elif opt == "--profile":
+            ctx['profile'] = int(arg)
+        elif not agents.parse_opt(ctx, opt, arg):
+            metrics.parse_opt(ctx, opt, arg)
+
+    if ctx['api_key'] is None:
+        usage()
+        sys.exit(2)
+
+    logger_util.setup_logger(ctx)
+
+    # the metrics setup comes first, it may fork the collector workers
+    metrics.setup(ctx)
+    agents.setup(ctx)
+
+    agents_tasks = scheduler.Scheduler(ctx['instruments'], ctx['profile'])
+    agents_tasks.add("agents", ctx['sync_interval'], agents.sync, ctx)
+    agents_tasks.start("agents-sync")
+
+    tasks = scheduler.Scheduler(ctx['instruments'], ctx['profile'])
+    metrics.add_tasks(tasks, ctx)
+    tasks.run()
+
+
+def usage():
+    usage = """collector.py
+    -h --help                               Prints this
+""" + agents.opts_usage + metrics.opts_usage + """    -r --rootfs <rootfs>                    Where the host filesystem is mounted (default to "/rootfs")
+    -d --debug                              Change log level to DEBUG, default to INFO
+    --profile <cycles>                      Profile the first cycles, the stats are written to /tmp
+    """
+    print usage
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
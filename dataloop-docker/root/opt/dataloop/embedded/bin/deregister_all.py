@@ -2,26 +2,36 @@ import getopt
 import sys
 import os
 
-from utils import api, docker_util
+from utils import api, docker_util, registry
 
 os.environ["NO_PROXY"] = "127.0.0.1"
 
 
 def deregister_all(ctx):
-    """Used as a cleanup task when dataloop-docker container is stopped."""
-    containers = docker_util.list_containers()
-    container_hashes = docker_util.get_container_hashes(containers)
-    api.deregister_agents(ctx, container_hashes)
+    """Used as a cleanup task when dataloop-docker container is stopped.
+
+    Deregister the agents in the local registry, docker is only asked when there is no registry yet.
+    """
+    if os.path.exists(ctx["registry_path"]):
+        agents = registry.AgentRegistry(ctx["registry_path"])
+        fingers = list(agents.fingers())
+        results = api.deregister_agents(ctx, fingers)
+        agents.remove([finger for finger, succeeded in zip(fingers, results) if succeeded])
+    else:
+        containers = docker_util.list_containers()
+        container_hashes = docker_util.get_container_hashes(containers)
+        api.deregister_agents(ctx, container_hashes)
 
 
 def main(argv):
     ctx = {
         "api_host": "https://agent.dataloop.io",
         "api_key": None,
+        "registry_path": registry.REGISTRY_PATH,
     }
 
     try:
-        opts, args = getopt.getopt(argv, "ha:u:", ["help", "apikey=", "apiurl="])
+        opts, args = getopt.getopt(argv, "ha:u:g:", ["help", "apikey=", "apiurl=", "registry="])
     except getopt.GetoptError, err:
         print str(err)
         usage()
@@ -35,6 +45,8 @@ def main(argv):
             ctx["api_key"] = arg
         elif opt in ("-u", "--apiurl"):
             ctx["api_host"] = arg
+        elif opt in ("-g", "--registry"):
+            ctx["registry_path"] = arg
 
     if ctx["api_key"] is None:
         usage()
@@ -48,6 +60,7 @@ def usage():
     -h --help                   Prints this
     -a --apikey <apikey>        Your dataloop api key
     -u --apiurl <apiurl>        The dataloop api url (default to "https://agent.dataloop.io")
+    -g --registry <path>        Where the registered agents are persisted (default to "/opt/dataloop/agents.json")
     """
     print usage
 
@@ -1,8 +1,12 @@
 import logging
+import math
 import socket
 import sys
+import time
 import getopt
-from utils import docker_util, docker_stats, logger_util
+import json
+from utils import docker_util, docker_stats, graphite, host_facts, instruments, inventory, logger_util, metadata
+from utils import http_server, metric_store, prometheus, scheduler, spool, tiers
 
 logger = logging.getLogger('METRICS')
 
@@ -11,46 +15,251 @@ def send_metrics(ctx):
     logger.info("metrics")
 
     try:
-        containers = map(format_container, docker_util.list_containers())
-        metrics = docker_stats.get_metrics(ctx["rootfs"], ctx["metric_interval"], containers)
+        with ctx["instruments"].timer("metrics.list_containers"):
+            docker_containers = ctx["inventory"].list_containers()
+
+        container_ids = [c.id for c in docker_containers]
+        ctx["metadata"].prune(container_ids)
+        ctx["tiers"].prune(container_ids)
+
+        # the containers of all the tiers due now share the same host snapshot
+        due = ctx["tiers"].get_due()
+        containers = [format_container(ctx, c) for c in docker_containers if get_interval(ctx, c) in due]
+        metrics = ctx["collector"].collect(containers)
+        ctx["collector"].prune([(c.id, docker_util.get_pid(c)) for c in docker_containers])
         publish_metrics(ctx, metrics)
 
     except Exception as ex:
         logger.error("metrics failed: %s" % ex, exc_info=True)
+        ctx["instruments"].incr("metrics.errors")
+        return
+
+    if "prometheus" in ctx:
+        export_metrics(ctx, docker_containers, containers, metrics)
+
+
+def export_metrics(ctx, docker_containers, containers, metrics):
+    """Render the prometheus body, after the graphite send which must not depend on it."""
+    try:
+        ctx["prometheus"].update(containers, metrics)
+        ctx["prometheus"].prune([ctx["metadata"].get_finger(c) for c in docker_containers])
+        ctx["prometheus"].render()
+
+    except Exception as ex:
+        logger.error("prometheus export failed: %s" % ex, exc_info=True)
+        ctx["instruments"].incr("metrics.prometheus.errors")
+
+
+def sample_metrics(ctx):
+    try:
+        with ctx["instruments"].timer("metrics.sample"):
+            docker_containers = ctx["inventory"].list_containers()
+            ctx["collector"].sample([format_container(ctx, c) for c in docker_containers])
+
+    except Exception as ex:
+        logger.error("metrics sampling failed: %s" % ex, exc_info=True)
+        ctx["instruments"].incr("metrics.sample.errors")
 
 
-def format_container(container):
+def add_tasks(tasks, ctx):
+    tasks.add("metrics", ctx["tiers"].tick, send_metrics, ctx)
+
+    if ctx["sample_interval"]:
+        tasks.add("samples", ctx["sample_interval"], sample_metrics, ctx)
+
+
+def format_container(ctx, container):
+    container_metadata = ctx["metadata"].get(container)
     return {
-        "finger": docker_util.get_hash(container),
+        "id": container.id,
+        "finger": container_metadata["finger"],
+        "name": container.name,
+        "image": container_metadata["image"],
         "pid": docker_util.get_pid(container)
     }
 
 
+def get_interval(ctx, container):
+    container_metadata = ctx["metadata"].get(container)
+    return ctx["tiers"].get_interval(container.id, container_metadata["image"], container_metadata["labels"])
+
+
 def publish_metrics(ctx, metrics):
-    message = ""
+    """Send the containers metrics, with the collector own metrics when the host finger is known.
+
+    The collector metrics about this send go out with the next cycle.
+    """
+    timestamp = int(time.time())
+
+    host_finger = ctx["host_facts"].get(host_facts.HOST_FINGER, None)
+    if host_finger:
+        metrics.update(ctx["instruments"].get_metrics(host_finger))
+
+    datapoints = [(path, value, timestamp) for path, value in metrics.iteritems()
+                  if isinstance(value, int) or isinstance(value, float)]
+    ctx["store"].add(datapoints)
+
+    try:
+        with ctx["instruments"].timer("metrics.send"):
+            ctx["sender"].send(datapoints)
+        ctx["instruments"].incr("metrics.datapoints", len(datapoints))
+
+    except socket.error as ex:
+        logger.error("graphite unavailable, spooling %d datapoints: %s" % (len(datapoints), ex))
+        ctx["spool"].append(datapoints)
+        ctx["instruments"].incr("metrics.spooled", len(datapoints))
+
+    ctx["instruments"].gauge("metrics.bytes_sent", ctx["sender"].bytes_sent)
+    ctx["instruments"].gauge("metrics.spool.skipped", ctx["spool"].skipped)
+
+
+def query_metrics(ctx, params):
+    """GET /query?finger=<prefix>&metric=<glob>&since=<timestamp>, the recent metrics as json."""
+    result = ctx["store"].query(params.get("finger", ""), params.get("metric", "*"), int(params.get("since", 0)))
+    return 200, "application/json", json.dumps(result)
+
+
+def prometheus_metrics(ctx, params):
+    """GET /metrics, the body rendered after the last collection."""
+    return 200, "text/plain; version=0.0.4", ctx["prometheus"].get_body()
+
+
+def setup(ctx):
+    """Create what the metrics collection needs, the inventory and metadata already in ctx are shared.
+
+    Must be called before any other thread is started, a process pool must not fork them.
+    """
+    if ctx['graphite_port'] is None:
+        ctx['graphite_port'] = graphite.PICKLE_PORT if ctx['graphite_pickle'] else graphite.PLAINTEXT_PORT
+
+    if "instruments" not in ctx:
+        ctx["instruments"] = instruments.Instruments()
+
+    ctx["tiers"] = tiers.Tiers(ctx["metric_interval"], ctx["metric_tiers"])
+
+    # enough samples for the longest interval between two collections
+    sample_capacity = 0
+    if ctx["sample_interval"]:
+        sample_capacity = int(math.ceil(float(max(ctx["tiers"].intervals)) / ctx["sample_interval"]))
+
+    ctx["collector"] = docker_stats.Collector(ctx["rootfs"], ctx["workers"], ctx["use_processes"],
+                                              ctx["instruments"], sample_capacity)
+    ctx["sender"] = graphite.GraphiteSender(ctx["graphite_host"], ctx["graphite_port"], ctx["graphite_pickle"])
+    ctx["spool"] = spool.Spool(ctx["spool_path"], ctx["sender"])
+    ctx["spool"].start()
+    ctx["store"] = metric_store.MetricStore(ctx["retention"])
+
+    if ctx["http_port"]:
+        routes = {"/query": lambda params: query_metrics(ctx, params)}
+
+        if ctx["prometheus_enabled"]:
+            ctx["prometheus"] = prometheus.PrometheusExporter()
+            routes["/metrics"] = lambda params: prometheus_metrics(ctx, params)
+
+        ctx["http_server"] = http_server.HttpServer(ctx["http_port"], routes, ctx["http_host"])
+        if not ctx["http_server"].start():
+            # nothing would serve it
+            ctx.pop("prometheus", None)
+
+    if "host_facts" not in ctx:
+        ctx["host_facts"] = host_facts.HostFacts()
+        ctx["host_facts"].start()
+
+    if "metadata" not in ctx:
+        ctx["metadata"] = metadata.MetadataCache()
+
+    if "inventory" not in ctx:
+        ctx["inventory"] = inventory.ContainerInventory()
+        ctx["inventory"].start()
+
+
+def parse_opt(ctx, opt, arg):
+    """Apply a metrics option to ctx, return False when it isn't one."""
+    if opt in ("-s", "--graphiteserver"):
+        ctx['graphite_host'] = arg
+    elif opt in ("-p", "--graphiteport"):
+        ctx['graphite_port'] = int(arg)
+    elif opt in ("-k", "--pickle"):
+        ctx['graphite_pickle'] = True
+    elif opt in ("-o", "--spool"):
+        ctx['spool_path'] = arg
+    elif opt in ("-w", "--workers"):
+        ctx['workers'] = int(arg)
+    elif opt == "--processes":
+        ctx['use_processes'] = True
+    elif opt in ("-t", "--tier"):
+        ctx['metric_tiers'] = ctx['metric_tiers'] + [tiers.parse_tier(arg)]
+    elif opt == "--sample-interval":
+        ctx['sample_interval'] = int(arg)
+    elif opt == "--http-port":
+        ctx['http_port'] = int(arg)
+    elif opt == "--http-host":
+        ctx['http_host'] = arg
+    elif opt == "--retention":
+        ctx['retention'] = int(arg)
+    elif opt == "--prometheus":
+        ctx['prometheus_enabled'] = True
+    else:
+        return False
+
+    return True
+
+
+defaults = {
+    "metric_interval": 30,
+    "metric_tiers": [],
+    "sample_interval": 0,
+    "http_port": http_server.PORT,
+    "http_host": http_server.HOST,
+    "retention": metric_store.RETENTION,
+    "prometheus_enabled": False,
+    "graphite_host": "graphite.dataloop.io",
+    "graphite_port": None,
+    "graphite_pickle": False,
+    "spool_path": "/opt/dataloop/spool",
+    "workers": 1,
+    "use_processes": False,
+}
 
-    for path, value in metrics.iteritems():
-        if isinstance(value, int) or isinstance(value, float):
-            message += "%s %s\n" % (path, value)
+short_opts = "s:p:ko:w:t:"
+long_opts = ["graphiteserver=", "graphiteport=", "pickle", "spool=", "workers=", "processes", "tier=",
+             "sample-interval=", "http-port=", "http-host=", "retention=",
+             "prometheus"]
 
-    if message:
-        sock = socket.socket()
-        sock.connect((ctx["graphite_host"], ctx["graphite_port"]))
-        sock.sendall(message)
-        sock.close()
+opts_usage = """    -s --graphiteserver <graphiteserver>    The graphite url (default to "graphite.dataloop.io")
+    -p --graphiteport <graphiteport>        The graphite port (default to "2003", or "2004" with --pickle)
+    -k --pickle                             Use the carbon pickle protocol instead of plaintext
+    -o --spool <path>                       Where to keep the metrics graphite couldn't receive
+                                            (default to "/opt/dataloop/spool")
+    -w --workers <workers>                  Number of workers reading the containers stats (default to "1")
+    --processes                             Use a pool of processes instead of threads for the workers
+    -t --tier <interval>:<pattern>          Collect every interval seconds the containers whose image or a label
+                                            matches the pattern, ex: 5:redis* (repeatable, default to every 30s)
+                                            all the tiers are collected from one thread, the cycles slower than
+                                            the shortest interval are counted in metrics.overruns
+    --sample-interval <seconds>             Also sample the cpu and network rates at this step, to publish their
+                                            avg/min/max/p95 over each interval (default to "0", disabled)
+    --http-port <port>                      Serve the recent metrics on /query?finger=<prefix>&metric=<glob>
+                                            (default to "8080", 0 to disable)
+    --http-host <address>                   The address the http server listens on, there is no authentication
+                                            (default to "127.0.0.1", local clients only)
+    --retention <seconds>                   How long the metrics are kept for /query (default to "600")
+    --prometheus                            Also serve the containers metrics on /metrics, in the prometheus
+                                            text format
+"""
 
 
 def main(argv):
     ctx = {
         "rootfs": "/rootfs",
-        "metric_interval": 30,
-        "graphite_host": "graphite.dataloop.io",
-        "graphite_port": 2003,
         "debug": False,
+        "profile": 0,
     }
+    ctx.update(defaults)
 
     try:
-        opts, args = getopt.getopt(argv, "hs:p:r:d", ["help", "graphiteserver=", "graphiteport=", "rootfs=", "debug"])
+        opts, args = getopt.getopt(argv, "h" + short_opts + "r:d",
+                                   ["help"] + long_opts + ["rootfs=", "debug", "profile="])
 
     except getopt.GetoptError, err:
         print str(err)
@@ -61,27 +270,29 @@ def main(argv):
         if opt in ("-h", "--help"):
             usage()
             sys.exit(2)
-        elif opt in ("-s", "--graphiteserver"):
-            ctx['graphite_host'] = arg
-        elif opt in ("-p", "--graphiteport"):
-            ctx['graphite_port'] = int(arg)
         elif opt in ("-r", "--rootfs"):
             ctx['rootfs'] = arg
         elif opt in ("-d", "--debug"):
             ctx["debug"] = True
+        elif opt == "--profile":
+            ctx["profile"] = int(arg)
+        else:
+            parse_opt(ctx, opt, arg)
 
     logger_util.setup_logger(ctx)
+    setup(ctx)
 
-    while True:
-        send_metrics(ctx)
+    tasks = scheduler.Scheduler(ctx["instruments"], ctx["profile"])
+    add_tasks(tasks, ctx)
+    tasks.run()
 
 
 def usage():
     usage = """metrics.py
     -h --help                               Prints this
-    -s --graphiteserver <graphiteserver>    The graphite url (default to "graphite.dataloop.io")
-    -p --graphiteport <graphiteport>        The graphite port (default to "2003")
-    -d --debug                  Change log level to DEBUG, default to INFO
+""" + opts_usage + """    -r --rootfs <rootfs>                    Where the host filesystem is mounted (default to "/rootfs")
+    -d --debug                              Change log level to DEBUG, default to INFO
+    --profile <cycles>                      Profile the first cycles, the stats are written to /tmp
     """
     print usage
 
@@ -1,61 +1,123 @@
 import logging
-import requests
-import grequests
+
+import http_client
 
 logger = logging.getLogger("API")
 
-API_TIMEOUT = 5
+# maximum number of agents per bulk request, 0 to always send one request per agent
+BATCH_SIZE = 0
+
+# the responses of a server which doesn't know the bulk route, others are only failures
+UNSUPPORTED_STATUSES = (400, 404, 405)
 
 
 def list_agents(ctx, mac):
     """List agents with the same mac address."""
     url = "%s/agents?mac=%s" % (ctx["api_host"], mac)
     headers = _get_request_headers(ctx)
-    try:
-        resp = requests.get(url, headers=headers, timeout=API_TIMEOUT)
-        resp.raise_for_status()
-        return resp.json()
-    except Exception as exception:
-        logger.error("request failed: %s" % url)
-        raise exception
+
+    resp = _get_client(ctx).request("list", "GET", url, headers=headers)
+    if resp is None or not resp.ok:
+        raise Exception("request failed: %s" % url)
+
+    return resp.json()
 
 
 def deregister_agents(ctx, agent_ids):
+    """Return a list of booleans, True for each agent which was deregistered."""
     api_host = ctx["api_host"]
     headers = _get_request_headers(ctx)
 
     def create_request(id):
         url = "%s/agents/%s/deregister" % (api_host, id)
-        return grequests.post(url, headers=headers, timeout=API_TIMEOUT)
+        return url, {"headers": headers}
+
+    def create_bulk_body(ids):
+        return {"ids": ids}
 
-    reqs = map(create_request, agent_ids)
-    grequests.map(reqs, exception_handler=_grequest_exception_handler)
+    return _send(ctx, "deregister", "POST", list(agent_ids), create_request, create_bulk_body)
 
 
 def tag_agents(ctx, agents):
-    """Update agent tags, will completely replace previous ones."""
+    """Update agent tags, will completely replace previous ones.
+
+    Return a list of booleans, True for each agent which was tagged.
+    """
     api_host = ctx["api_host"]
     headers = _get_request_headers(ctx)
 
     def create_request(agent):
         url = "%s/agents/%s/tags" % (api_host, agent["finger"])
-        return grequests.put(url, json=agent, headers=headers, timeout=API_TIMEOUT)
+        return url, {"json": agent, "headers": headers}
 
-    reqs = map(create_request, agents)
-    grequests.map(reqs, exception_handler=_grequest_exception_handler)
+    def create_bulk_body(agents):
+        return {"agents": agents}
+
+    return _send(ctx, "tags", "PUT", agents, create_request, create_bulk_body)
 
 
 def ping_agents(ctx, agents):
-    """Send a ping to the exchange, will also register agents if they arent already."""
+    """Send a ping to the exchange, will also register agents if they arent already.
+
+    Return a list of booleans, True for each agent which was pinged.
+    """
     api_host = ctx["api_host"]
     headers = _get_request_headers(ctx)
 
     def create_request(agent):
         url = "%s/agents/%s/ping" % (api_host, agent["finger"])
-        return grequests.post(url, json=agent, headers=headers, timeout=API_TIMEOUT)
+        return url, {"json": agent, "headers": headers}
+
+    def create_bulk_body(agents):
+        return {"agents": agents}
+
+    return _send(ctx, "ping", "POST", agents, create_request, create_bulk_body)
+
+
+def get_stats(ctx):
+    """Requests, errors, retries and latency per endpoint since the process started."""
+    return _get_client(ctx).get_stats()
 
-    reqs = map(create_request, agents)
-    grequests.map(reqs, exception_handler=_grequest_exception_handler)
+
+def _send(ctx, endpoint, method, items, create_request, create_bulk_body):
+    """Send the items in chunks to /bulk/agents/<endpoint>, or one request per item.
+
+    The bulk route can't be mistaken for /agents/<finger>/<endpoint>. If the server rejects
+    it (400, 404 or 405), the items are sent one by one and the bulk route isn't tried again
+    for that endpoint. Other errors, ex: 401 or 429, only fail the chunk.
+    Return a list of booleans, True for each item which was sent.
+    """
+    client = _get_client(ctx)
+    batch_size = ctx.get("api_batch_size", BATCH_SIZE)
+    unsupported = ctx.setdefault("api_bulk_unsupported", set())
+
+    if items and batch_size and endpoint not in unsupported:
+        url = "%s/bulk/agents/%s" % (ctx["api_host"], endpoint)
+        headers = _get_request_headers(ctx)
+
+        chunks = [items[i:i + batch_size] for i in xrange(0, len(items), batch_size)]
+        reqs = [(url, {"json": create_bulk_body(chunk), "headers": headers}) for chunk in chunks]
+        responses = client.request_many("bulk_" + endpoint, method, reqs)
+
+        if not any(_is_rejected(resp) for resp in responses):
+            results = []
+            for chunk, succeeded in zip(chunks, _succeeded(responses)):
+                results += [succeeded] * len(chunk)
+            return results
+
+        logger.warn("bulk %s isn't supported by %s, sending one request per agent" % (endpoint, ctx["api_host"]))
+        unsupported.add(endpoint)
+
+    reqs = map(create_request, items)
+    return _succeeded(client.request_many(endpoint, method, reqs))
+
+
+def _get_client(ctx):
+    """One client per process, shared by all the api calls."""
+    if "api_client" not in ctx:
+        ctx["api_client"] = http_client.HttpClient(ctx.get("api_concurrency", http_client.CONCURRENCY))
+
+    return ctx["api_client"]
 
 
 def _get_request_headers(ctx):
@@ -65,6 +127,10 @@ def _get_request_headers(ctx):
     }
 
 
-def _grequest_exception_handler(request, exception):
-    logger.error("request failed: %s" % request.url)
-    raise exception
+def _is_rejected(resp):
+    """Whether the server doesn't support a request, errors and unreachable servers are only failures."""
+    return resp is not None and resp.status_code in UNSUPPORTED_STATUSES
+
+
+def _succeeded(responses):
+    return [resp is not None and resp.ok for resp in responses]
@@ -1,4 +1,6 @@
 import os
+import select
+import sys
 import logging
 from collections import defaultdict
 
@@ -6,11 +8,20 @@ logger = logging.getLogger('CGROUPS')
 
 cgroup_subsystems = ["memory", "cpuacct", "blkio"]
 
+# cgroup v2 has a single hierarchy for all the controllers
+UNIFIED = "unified"
+
+# how deep to look for the cgroup of a container in another cgroup namespace, ex: system.slice/docker-<id>.scope
+NAMESPACED_SEARCH_DEPTH = 3
+
 software_clock = os.sysconf_names['SC_CLK_TCK']
 ticks_per_second = os.sysconf(software_clock)
 
 nanoseconds_per_second = 1000000000
 
+# keeps the stat files open between snapshots when set, see set_file_cache
+file_cache = None
+
 
 def _bytes_to_gb(num):
     return round(float(num) / 1024 / 1024 / 1024, 2)
@@ -20,6 +31,20 @@ def _ticks_to_nanoseconds(num):
     return num * nanoseconds_per_second / ticks_per_second
 
 
+def set_file_cache(cache):
+    """Read the stat files through a file_cache.FileCache, or open them on every read if None."""
+    global file_cache
+    file_cache = cache
+
+
+def _read_stat_file(stat_path):
+    if file_cache:
+        return file_cache.read(stat_path)
+
+    with open(stat_path, 'r') as fp:
+        return fp.read()
+
+
 """
 cgroups
 """
@@ -42,15 +67,20 @@ def find_mountpoints(rootfs):
         'cpuacct': '/rootfs/sys/fs/cgroup/cpu,cpuacct',
         'memory': '/rootfs/sys/fs/cgroup/memory'
     }
+
+    or on hosts which only mount the cgroup v2 unified hierarchy:
+    {
+        'unified': '/rootfs/sys/fs/cgroup'
+    }
     """
     mountpoints = {}
-    mount_path = os.path.join(rootfs, "/proc/mounts")
+    mount_path = os.path.join(rootfs, "proc/mounts")
     logger.debug("finding mounted cgroups in %s" % mount_path)
 
     with open(mount_path) as fp:
         mounts = map(lambda x: x.split(), fp.read().splitlines())
 
-    cgroup_mounts = filter(lambda x: x[2] == "cgroup" and os.path.exists(x[1]), mounts)
+    cgroup_mounts = filter(lambda x: x[2] in ["cgroup", "cgroup2"] and os.path.exists(x[1]), mounts)
 
     # only keep the host cgroups mounts
     rootfs_mounts = filter(lambda x: x[1].startswith(rootfs), cgroup_mounts)
@@ -62,11 +92,20 @@ def find_mountpoints(rootfs):
             rootfs_mounts.append(mount)
 
     # find the subsystems we are interested in
-    for _, mountpoint, _, opts, _, _ in rootfs_mounts:
+    unified_mountpoint = None
+    for _, mountpoint, fs_type, opts, _, _ in rootfs_mounts:
+        if fs_type == "cgroup2":
+            unified_mountpoint = mountpoint
+            continue
+
         for opt in opts.split(','):
             if opt in cgroup_subsystems:
                 mountpoints[opt] = mountpoint
 
+    # hybrid hosts mount both, the v1 controllers are still the ones in use there
+    if not(mountpoints) and unified_mountpoint:
+        mountpoints[UNIFIED] = unified_mountpoint
+
     if not(mountpoints):
         logger.error("can't find mounted cgroups in %s" % mount_path)
 
@@ -82,6 +121,15 @@ def find_container_cgroups(rootfs, mountpoints, pid):
         'cpuacct': '/rootfs/sys/fs/cgroup/cpu,cpuacct/docker/container_id',
         'memory': '/rootfs/sys/fs/cgroup/memory/docker/'container_id'
     }
+
+    with cgroup v2 the only line is "0::<path>":
+    {
+        'unified': '/rootfs/sys/fs/cgroup/system.slice/docker-<container_id>.scope'
+    }
+
+    cgroup v2 hosts give each container its own cgroup namespace by default, the paths
+    are then relative to the cgroup of this container, ex: "0::/../docker-<id>.scope",
+    see _find_namespaced_cgroup.
     """
     cgroups = {}
     proc_path = os.path.join(rootfs, 'proc', str(pid), 'cgroup')
@@ -97,10 +145,17 @@ def find_container_cgroups(rootfs, mountpoints, pid):
 
     for names, path in subsystems.items():
 
+        if names == "" and UNIFIED in mountpoints:
+            cgroups[UNIFIED] = _join_cgroup_path(mountpoints[UNIFIED], path)
+            continue
+
         # sometimes multiple cgroups are grouped in here, like cpu,cpuacct
         for cgroup in names.split(','):
             if cgroup in cgroup_subsystems:
-                cgroups[cgroup] = os.path.join(mountpoints[cgroup], path)
+                cgroups[cgroup] = _join_cgroup_path(mountpoints[cgroup], path)
+
+    # a namespaced path which couldn't be found
+    cgroups = dict((name, path) for name, path in cgroups.items() if path)
 
     if not(cgroups):
         logger.error("can't find container cgroups in %s" % proc_path)
@@ -108,19 +163,169 @@ def find_container_cgroups(rootfs, mountpoints, pid):
     return cgroups
 
 
+def _join_cgroup_path(mountpoint, path):
+    if ".." not in path.split("/"):
+        return os.path.join(mountpoint, path)
+
+    return _find_namespaced_cgroup(mountpoint, path)
+
+
+def _find_namespaced_cgroup(mountpoint, path):
+    """Find a path relative to the cgroup namespace of this container, ex: ../docker-<id>.scope
+
+    What is left after the leading ".." is searched for under the mountpoint, down to
+    NAMESPACED_SEARCH_DEPTH levels. Return None if it can't be found, running this container
+    with --cgroupns=host avoids the search.
+    """
+    parts = os.path.normpath(path).split("/")
+    tail = os.path.join(*[part for part in parts if part != ".."] or [""])
+
+    if tail:
+        parents = [mountpoint]
+        for _ in xrange(NAMESPACED_SEARCH_DEPTH + 1):
+            for parent in parents:
+                candidate = os.path.join(parent, tail)
+                if os.path.isdir(candidate):
+                    return candidate
+
+            parents = [os.path.join(parent, name) for parent in parents for name in _list_dirs(parent)]
+
+    logger.error("can't find the namespaced cgroup %s under %s, run with --cgroupns=host" % (path, mountpoint))
+    return None
+
+
+def _list_dirs(path):
+    try:
+        return [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+    except OSError:
+        return []
+
+
+class CgroupResolver(object):
+    """Cache the cgroups mountpoints and the containers cgroups paths between cycles.
+
+    The mountpoints are only parsed again when the mounts change, a container cgroups paths
+    only when its pid changes or when it is pruned.
+    """
+
+    def __init__(self, rootfs):
+        self.rootfs = rootfs
+        self.mounts_stat = None
+        self.mounts_file = None
+        self.mounts_poller = None
+        self.mountpoints = {}
+        self.cgroups = {}
+        self.hits = 0
+        self.misses = 0
+        self.mounts_reloads = 0
+
+    def refresh_mountpoints(self):
+        """Parse the mounts file again if it changed since the last call.
+
+        The inode and mtime of the procfs mounts file never change, a change of the mounts is
+        signaled by POLLPRI|POLLERR on the open file instead. The stat covers a regular file.
+        """
+        mounts_path = os.path.join(self.rootfs, "proc/mounts")
+        mount_stat = os.stat(mounts_path)
+        mounts_stat = (mount_stat.st_ino, mount_stat.st_mtime)
+
+        if self._mounts_changed(mounts_path) or mounts_stat != self.mounts_stat:
+            self.mountpoints = find_mountpoints(self.rootfs)
+            self.mounts_stat = mounts_stat
+            self.mounts_reloads += 1
+
+            # the containers paths are built from the mountpoints
+            self.cgroups = {}
+
+        return self.mountpoints
+
+    def _mounts_changed(self, mounts_path):
+        if self.mounts_poller is None:
+            # opened before the first parse, so no change after it is missed
+            self.mounts_file = open(mounts_path)
+            self.mounts_poller = select.poll()
+            self.mounts_poller.register(self.mounts_file, select.POLLPRI | select.POLLERR)
+            return False
+
+        return any(events & (select.POLLPRI | select.POLLERR) for _, events in self.mounts_poller.poll(0))
+
+    def get_container_cgroups(self, container_id, pid):
+        key = (container_id, pid)
+        cgroups = self.cgroups.get(key)
+
+        if cgroups:
+            self.hits += 1
+            return cgroups
+
+        self.misses += 1
+        cgroups = find_container_cgroups(self.rootfs, self.mountpoints, pid)
+
+        # don't cache a failed lookup, it will be retried on the next cycle
+        if cgroups:
+            self.cgroups[key] = cgroups
+
+        return cgroups
+
+    def prune(self, keys):
+        """Forget the containers which are not in keys, a list of (container_id, pid).
+
+        return the cgroups of the forgotten containers, by (container_id, pid).
+        """
+        keys = set(keys)
+        pruned = {}
+
+        for key in self.cgroups.keys():
+            if key not in keys:
+                pruned[key] = self.cgroups.pop(key)
+
+        return pruned
+
+    def get_stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "mounts_reloads": self.mounts_reloads,
+            "containers": len(self.cgroups),
+        }
+
+
+"""
+host stats
+"""
+
+
+def get_host_stats(rootfs):
+    """Read the host wide files once per snapshot, the result is shared by all its containers.
+
+    {
+        'cpu': {'total': 1864550000000, 'cores': 4},
+        'memory': {'total': 8244441088, 'swap': 2147479552}
+    }
+    """
+    host_stats = {"cpu": {}, "memory": {}}
+
+    try:
+        host_stats["cpu"] = _parse_cpu_total_file(rootfs)
+        host_stats["memory"] = _parse_host_memory_file(rootfs)
+
+    except Exception as ex:
+        logger.error("host metrics will be missing: %s" % ex, exc_info=True)
+
+    return host_stats
+
+
 """
 memory stats
 """
 
 
-def get_memory_stats(rootfs, cgroup_path, pid):
+def get_memory_stats(host_stats, cgroup_path, pid):
     memory_stats = {}
 
     try:
-        host_stats = _parse_host_memory_file(rootfs)
         proc_stats = _parse_memory_stat_file(cgroup_path)
 
-        memory_stats = _format_memory_stats(proc_stats, host_stats)
+        memory_stats = _format_memory_stats(proc_stats, host_stats["memory"])
 
     except Exception as ex:
         logger.error("process %s - memory metrics will be missing: %s" % (pid, ex), exc_info=True)
@@ -131,20 +336,18 @@ def get_memory_stats(rootfs, cgroup_path, pid):
 # note: values in /proc/meminfo are set in kb
 def _parse_host_memory_file(rootfs):
     host_memory = {}
-    host_memory_path = os.path.join(rootfs, "/proc/meminfo")
+    host_memory_path = os.path.join(rootfs, "proc/meminfo")
     logger.debug("finding host memory info in %s" % host_memory_path)
 
-    with open(host_memory_path, 'r') as fp:
-        lines = fp.readlines()
+    data = _read_stat_file(host_memory_path)
 
-    for line in lines:
-        cols = line.split(':')
-        if cols[0] == 'MemTotal':
-            total = cols[1].strip().split(' ')[0]
-            host_memory["total"] = int(total) * 1024
-        elif cols[0] == "SwapTotal":
-            swap = cols[1].strip().split(' ')[0]
-            host_memory["swap"] = int(swap) * 1024
+    for line in data.splitlines():
+        name, _, value = line.partition(':')
+        if name == 'MemTotal':
+            host_memory["total"] = int(value.split()[0]) * 1024
+        elif name == "SwapTotal":
+            host_memory["swap"] = int(value.split()[0]) * 1024
+            break
 
     if not host_memory:
         logger.error("can't find host memory info in %s" % host_memory_path)
@@ -153,20 +356,75 @@ def _parse_host_memory_file(rootfs):
 
 
 def _parse_memory_stat_file(cgroup_path):
-    stats = {}
+    stats = defaultdict(int)
     stat_path = os.path.join(cgroup_path, "memory.stat")
     logger.debug("finding memory stats in %s" % stat_path)
 
-    with open(stat_path, 'r') as fp:
-        lines = fp.read().splitlines()
-
-    stats = dict(map(lambda x: x.split(' ', 1), lines))
-    stats = {k: int(v) for k, v in stats.items()}
+    for line in _read_stat_file(stat_path).splitlines():
+        name, _, value = line.partition(' ')
+        stats[name] = int(value)
 
     if not stats:
         logger.error("can't find memory stats in %s" % stat_path)
 
-    return defaultdict(int, stats)
+    return stats
+
+
+def get_unified_memory_stats(host_stats, cgroup_path, pid):
+    memory_stats = {}
+
+    try:
+        proc_stats = _parse_unified_memory_files(cgroup_path)
+
+        memory_stats = _format_memory_stats(proc_stats, host_stats["memory"])
+
+    except Exception as ex:
+        logger.error("process %s - memory metrics will be missing: %s" % (pid, ex), exc_info=True)
+
+    return memory_stats
+
+
+def _parse_unified_memory_files(cgroup_path):
+    """Read the cgroup v2 memory files and return them with the cgroup v1 memory.stat names.
+
+    memory.current also accounts the kernel memory, it is counted in rss so the used memory
+    (rss + cache + swap) matches memory.current + memory.swap.current.
+    """
+    stats = _parse_memory_stat_file(cgroup_path)
+
+    current = _parse_unified_value_file(cgroup_path, "memory.current")
+    limit = _parse_unified_value_file(cgroup_path, "memory.max")
+    swap = _parse_unified_value_file(cgroup_path, "memory.swap.current", 0)
+    swap_limit = _parse_unified_value_file(cgroup_path, "memory.swap.max", 0)
+
+    stats["cache"] = stats["file"]
+    stats["rss"] = max(current - stats["file"], 0)
+    stats["swap"] = swap
+    stats["hierarchical_memory_limit"] = limit
+    stats["hierarchical_memsw_limit"] = swap_limit
+
+    return stats
+
+
+def _parse_unified_value_file(cgroup_path, file_name, default=None):
+    """Read a single value cgroup v2 file, "max" (no limit) is returned as sys.maxint.
+
+    if the file doesn't exist (ex: swap accounting disabled), default is returned when set.
+    """
+    stat_path = os.path.join(cgroup_path, file_name)
+    logger.debug("finding memory stat in %s" % stat_path)
+
+    try:
+        value = _read_stat_file(stat_path).strip()
+    except EnvironmentError:
+        if default is None:
+            raise
+        return default
+
+    if value == "max":
+        return sys.maxint
+
+    return int(value)
 
 
 def _format_memory_stats(stats, host_memory):
@@ -225,16 +483,18 @@ def _parse_blkio_file(cgroup_path, file_name, uom):
     stat_path = os.path.join(cgroup_path, "blkio." + file_name)
     logger.debug("finding disk stats in %s" % stat_path)
 
-    with open(stat_path, 'r') as fp:
-        lines = fp.read().splitlines()
+    read_name = "read_" + uom
+    write_name = "write_" + uom
 
-    for line in lines:
-        if 'Read' in line:
-            metric_name = "read_" + uom
-            stats[metric_name] += int(line.split()[2])
-        if 'Write' in line:
-            metric_name = "write_" + uom
-            stats[metric_name] += int(line.split()[2])
+    # ex: "8:0 Read 4096", the last line is the "Total 8192" of all the devices
+    for line in _read_stat_file(stat_path).splitlines():
+        cols = line.split()
+        if len(cols) != 3:
+            continue
+        if cols[1] == 'Read':
+            stats[read_name] += int(cols[2])
+        elif cols[1] == 'Write':
+            stats[write_name] += int(cols[2])
 
     if not(stats):
         logger.error("can't find disk stats in %s" % stat_path)
@@ -242,18 +502,60 @@ def _parse_blkio_file(cgroup_path, file_name, uom):
     return stats
 
 
+def get_io_stats(cgroup_path, pid):
+    io_stats = {}
+
+    try:
+        io_stats.update(_parse_io_stat_file(cgroup_path))
+
+    except Exception as ex:
+        logger.error("process %s - disk metrics will be missing: %s" % (pid, ex), exc_info=True)
+
+    return io_stats
+
+
+def _parse_io_stat_file(cgroup_path):
+    """Read the cgroup v2 io.stat file, one line per device.
+
+    ex: "8:0 rbytes=1459200 wbytes=314773504 rios=192 wios=353 dbytes=0 dios=0"
+    the devices are summed up with the same names as the blkio stats.
+    """
+    io_stat_names = {
+        "rbytes": "read_bytes",
+        "wbytes": "write_bytes",
+        "rios": "read_count",
+        "wios": "write_count",
+    }
+
+    stats = defaultdict(int)
+    stat_path = os.path.join(cgroup_path, "io.stat")
+    logger.debug("finding disk stats in %s" % stat_path)
+
+    for line in _read_stat_file(stat_path).splitlines():
+        for col in line.split()[1:]:
+            key, _, value = col.partition('=')
+            if key in io_stat_names:
+                stats[io_stat_names[key]] += int(value)
+
+    # no io yet, the file is empty until the container reads or writes to a device
+    for name in io_stat_names.values():
+        stats[name] += 0
+
+    return stats
+
+
 """
 cpu stats
 """
 
 
-def get_cpu_stats(rootfs, cgroup_path, pid):
+def get_cpu_stats(host_stats, cgroup_path, pid):
     cpu_stats = {}
 
     try:
         cpu_stats["usage"] = _parse_cpu_usage_file(cgroup_path)
         cpu_stats["cores"] = len(_parse_usage_percpu_file(cgroup_path))
-        cpu_stats["total"] = _parse_cpu_total_file(rootfs)
+        cpu_stats["total"] = host_stats["cpu"]["total"]
         cpu_stats.update(_parse_cpu_stat_file(cgroup_path))
 
     except Exception as ex:
@@ -262,16 +564,50 @@ def get_cpu_stats(rootfs, cgroup_path, pid):
     return cpu_stats
 
 
+def get_unified_cpu_stats(host_stats, cgroup_path, pid):
+    cpu_stats = {}
+
+    try:
+        # cgroup v2 has no per cpu usage file, count the host cpus instead
+        cpu_stats["total"] = host_stats["cpu"]["total"]
+        cpu_stats["cores"] = host_stats["cpu"]["cores"]
+        cpu_stats.update(_parse_unified_cpu_stat_file(cgroup_path))
+
+    except Exception as ex:
+        logger.error("process %s - cpu metrics will be missing: %s" % (pid, ex), exc_info=True)
+
+    return cpu_stats
+
+
+def _parse_unified_cpu_stat_file(cgroup_path):
+    """Read the cgroup v2 cpu.stat file, times are in microseconds."""
+    cpu_stats = {"usage": 0, "user": 0, "system": 0}
+    stat_names = {"usage_usec": "usage", "user_usec": "user", "system_usec": "system"}
+
+    stat_path = os.path.join(cgroup_path, "cpu.stat")
+    logger.debug("finding cpu stats in %s" % stat_path)
+
+    lines = _read_stat_file(stat_path).splitlines()
+
+    if not lines:
+        logger.error("can't find cpu stats in %s" % stat_path)
+
+    for line in lines:
+        key, _, value = line.partition(' ')
+        if key in stat_names:
+            cpu_stats[stat_names[key]] = int(value) * 1000
+
+    return cpu_stats
+
+
 def _parse_cpu_usage_file(cgroup_path):
     usage = 0
     stat_path = os.path.join(cgroup_path, "cpuacct.usage")
     logger.debug("finding usage stat in %s" % stat_path)
 
-    path = os.path.join(cgroup_path, "cpuacct.usage")
-    with open(path, 'r') as fp:
-        line = fp.readline()
-        if line:
-            usage = int(line)
+    data = _read_stat_file(stat_path)
+    if data:
+        usage = int(data)
 
     if not(usage):
         logger.error("can't find usage stat in %s" % stat_path)
@@ -280,14 +616,10 @@ def _parse_cpu_usage_file(cgroup_path):
 
 
 def _parse_usage_percpu_file(cgroup_path):
-    usage_per_cpu = []
     stat_path = os.path.join(cgroup_path, "cpuacct.usage_percpu")
     logger.debug("finding usage per cpu stats in %s" % stat_path)
 
-    with open(stat_path, 'r') as fp:
-        line = fp.readline()
-        if line:
-            usage_per_cpu = line.strip().split(' ')
+    usage_per_cpu = _read_stat_file(stat_path).split()
 
     if not(usage_per_cpu):
         logger.error("can't find usage per cpu stats in %s" % stat_path)
@@ -296,23 +628,26 @@ def _parse_usage_percpu_file(cgroup_path):
 
 
 def _parse_cpu_total_file(rootfs):
-    total = 0
+    """Read the total cpu time and count the cpu<N> lines in /proc/stat."""
+    total, cores = 0, 0
     stat_path = os.path.join(rootfs, 'proc/stat')
     logger.debug("finding cpu total stat in %s" % stat_path)
 
-    with open(stat_path, 'r') as fp:
-        lines = fp.readlines()
+    for l in _read_stat_file(stat_path).splitlines():
+        # the cpu lines come first, the rest of the file is not needed
+        if not l.startswith('cpu'):
+            break
 
-    for l in lines:
-        cols = l.split(' ')
-        if str(cols[0]).strip() == 'cpu':
-            total = sum(int(c) for c in cols[2:10])
+        if l[3] == ' ':
+            total = sum(int(c) for c in l.split()[1:9])
             total = _ticks_to_nanoseconds(total)
+        else:
+            cores += 1
 
     if not(total):
         logger.error("can't find cpu total stat in %s" % stat_path)
 
-    return total
+    return {"total": total, "cores": cores}
 
 
 def _parse_cpu_stat_file(cgroup_path):
@@ -320,13 +655,14 @@ def _parse_cpu_stat_file(cgroup_path):
     stat_path = os.path.join(cgroup_path, "cpuacct.stat")
     logger.debug("finding cpu stats in %s" % stat_path)
 
-    with open(stat_path, 'r') as fp:
-        stats = dict(map(lambda x: x.split(' ', 1), fp.read().splitlines()))
+    lines = _read_stat_file(stat_path).splitlines()
 
-    if stats:
-        cpu_stats['user'] = _ticks_to_nanoseconds(int(stats.get('user')))
-        cpu_stats['system'] = _ticks_to_nanoseconds(int(stats.get('system')))
-    else:
+    for line in lines:
+        name, _, value = line.partition(' ')
+        if name in cpu_stats:
+            cpu_stats[name] = _ticks_to_nanoseconds(int(value))
+
+    if not lines:
         logger.error("can't find cpu stats in %s" % stat_path)
 
     return cpu_stats
@@ -366,15 +702,10 @@ def _parse_net_file(rootfs, pid):
     stat_path = os.path.join(rootfs, 'proc', str(pid), 'net/dev')
     logger.debug("finding net stats in %s" % stat_path)
 
-    with open(stat_path, 'r') as fp:
-        lines = fp.readlines()
-
     # the first two lines are headers, we can skip them
-    for l in lines[2:]:
-        cols = l.split(':', 1)
-        interface_name = str(cols[0]).strip()
-        interface_stats = cols[1].split()
-        net_stats[interface_name] = interface_stats
+    for l in _read_stat_file(stat_path).splitlines()[2:]:
+        interface_name, _, interface_stats = l.partition(':')
+        net_stats[interface_name.strip()] = interface_stats.split()
 
     if not(net_stats):
         logger.error("can't find net stats in %s" % stat_path)
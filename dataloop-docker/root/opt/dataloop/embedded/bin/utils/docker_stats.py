@@ -1,127 +1,426 @@
 import logging
+import multiprocessing
+import multiprocessing.pool
+import os
 import cgroups_util
+import file_cache
+import ring_buffer
+from instruments import Instruments
 import time
 
 logger = logging.getLogger('DOCKERSTATS')
 
+# the aggregates of the sampled rates, in the order of RingBuffer.get_aggregates
+aggregate_suffixes = ('_avg', '_min', '_max', '_p95')
+
+
+class Collector(object):
+    """Keep the last snapshot of every container between cycles.
+
+    Each call to `collect` reads the cgroups and /proc files once and computes the rates
+    against the sample cached for the same container id and pid on its previous collection.
+    The graphite paths of a container are built once, when it is first collected. The samples
+    and paths of the containers which are gone are dropped by `prune`.
+
+    With more than one worker, the containers stats are read concurrently by a pool of
+    threads, or of processes for very large hosts. The pool must be created before any
+    other thread is started.
+
+    The stat files are kept open between cycles, except with a process pool where each
+    worker would keep its own descriptors.
+
+    The time spent in each phase of a cycle is recorded in `instruments`.
+
+    Between two collections, `sample` can read the cpu and network counters alone at a
+    finer step. Their rates go to ring buffers of `sample_capacity` values per container
+    and metric, the next collection adds their avg/min/max/p95 to the metrics.
+    """
+
+    def __init__(self, rootfs, workers=1, use_processes=False, instruments=None, sample_capacity=0):
+        self.rootfs = rootfs
+        self.instruments = instruments or Instruments()
+        self.resolver = cgroups_util.CgroupResolver(rootfs)
+        self.samples = {}
+        self.paths = {}
+        self.sample_capacity = sample_capacity
+        self.subsamples = {}
+        self.buffers = {}
+        self.pool = None
+        self.files = None
+
+        if workers > 1 and use_processes:
+            self.pool = multiprocessing.Pool(workers)
+        elif workers > 1:
+            self.pool = multiprocessing.pool.ThreadPool(workers)
+
+        if not use_processes:
+            self.files = file_cache.FileCache()
+            cgroups_util.set_file_cache(self.files)
+
+    def collect(self, containers):
+        metrics = {}
 
-def get_metrics(rootfs, interval, containers):
-    metrics = {}
+        with self.instruments.timer("metrics.cgroups"):
+            self.resolver.refresh_mountpoints()
+            containers = _add_containers_cgroups(self.resolver, containers)
 
-    mountpoints = cgroups_util.find_mountpoints(rootfs)
-    _add_containers_cgroups(rootfs, mountpoints, containers)
+        with self.instruments.timer("metrics.snapshot"):
+            # host wide files are read once, all the containers share the same snapshot
+            host_stats = cgroups_util.get_host_stats(self.rootfs)
+            _add_containers_stats(self.rootfs, host_stats, containers, "now_stats", self.pool)
 
-    _add_containers_stats(rootfs, containers, "prev_stats")
-    time.sleep(interval)
-    _add_containers_stats(rootfs, containers, "now_stats")
+        samples = {}
+        with self.instruments.timer("metrics.compute"):
+            for container in containers:
+                key = (container.get("id"), container.get("pid"))
+                paths = self._get_paths(key, container)
+                now_stats = container.pop("now_stats")
+                now_sample = Sample(now_stats)
 
-    for container in containers:
-        finger = container.get("finger")
-        now_stats = container.get("now_stats")
-        prev_stats = container.get("prev_stats")
+                container_metrics = _get_container_metrics(paths, now_stats.get("memory") or {}, now_sample,
+                                                           self.samples.get(key))
+                metrics.update(container_metrics)
+                samples[key] = now_sample
 
-        container_metrics = _get_container_metrics(finger, now_stats, prev_stats, interval)
-        metrics.update(container_metrics)
+                if key in self.buffers:
+                    metrics.update(_get_aggregate_metrics(paths, self.buffers[key]))
 
-    return metrics
+        self.instruments.incr("metrics.containers", len(containers))
+
+        self.samples.update(samples)
+        return metrics
+
+    def sample(self, containers):
+        """Buffer the cpu and network rates of the containers since their previous sample."""
+        self.resolver.refresh_mountpoints()
+        containers = _add_containers_cgroups(self.resolver, containers)
+        host_stats = cgroups_util.get_host_stats(self.rootfs)
+
+        for container in containers:
+            key = (container.get("id"), container.get("pid"))
+            now_sample = Sample(_get_container_rate_stats(self.rootfs, host_stats, container))
+            prev_sample = self.subsamples.get(key)
+            self.subsamples[key] = now_sample
 
+            if not prev_sample:
+                continue
+
+            interval = now_sample.timestamp - prev_sample.timestamp
+            if interval <= 0:
+                continue
+
+            buffers = self.buffers.setdefault(key, {})
+            rates = _get_rate_metrics(self._get_paths(key, container), now_sample, prev_sample, interval)
+            for path, value in rates.iteritems():
+                if path not in buffers:
+                    buffers[path] = ring_buffer.RingBuffer(self.sample_capacity)
+                buffers[path].append(value)
+
+    def prune(self, keys):
+        """Forget the containers which aren't in keys, (id, pid) of every running container.
+
+        Containers that are gone (or restarted with a new pid) are dropped here.
+        """
+        keys = set(keys)
+        for samples in (self.samples, self.paths, self.subsamples, self.buffers):
+            for key in samples.keys():
+                if key not in keys:
+                    del samples[key]
+
+        pruned = self.resolver.prune(keys)
+        logger.debug("cgroups resolver: %s" % self.resolver.get_stats())
+
+        if self.files:
+            self._close_files(pruned)
+
+    def _get_paths(self, key, container):
+        paths = self.paths.get(key)
+
+        if paths is None:
+            paths = self.paths[key] = ContainerPaths(container.get("finger"))
+
+        return paths
+
+    def _close_files(self, pruned):
+        for (_, pid), cgroups in pruned.items():
+            self.files.evict(os.path.join(self.rootfs, 'proc', str(pid), ''))
+            for cgroup_path in cgroups.values():
+                self.files.evict(os.path.join(cgroup_path, ''))
+
+        self.files.trim()
+
+        stats = self.files.get_stats()
+        logger.debug("file cache: %s" % stats)
+        self.instruments.gauge("files.open", stats["files"])
+        self.instruments.gauge("files.opened", stats["opened"])
+        self.instruments.gauge("files.reads", stats["reads"])
+
+
+def _add_containers_cgroups(resolver, containers):
+    """Return the containers whose cgroups were found, the others are left out of this snapshot."""
+    resolved = []
 
-def _add_containers_cgroups(rootfs, mountpoints, containers):
     for container in containers:
-        pid = container.get("pid")
-        cgroups = cgroups_util.find_container_cgroups(rootfs, mountpoints, pid)
+        try:
+            cgroups = resolver.get_container_cgroups(container.get("id"), container.get("pid"))
+        except Exception as ex:
+            # ex: the container process just exited
+            logger.warn("can't find the cgroups of container %s: %s" % (container.get("id"), ex))
+            continue
+
+        if cgroups_util.UNIFIED not in cgroups and not all(name in cgroups for name in cgroups_util.cgroup_subsystems):
+            logger.debug("skipping container %s, missing cgroups: %s" % (container.get("id"), sorted(cgroups)))
+            continue
+
         container["cgroups"] = cgroups
+        resolved.append(container)
 
+    return resolved
 
-def _add_containers_stats(rootfs, containers, key):
-    for container in containers:
-        stats = _get_container_stats(rootfs, container)
+
+def _add_containers_stats(rootfs, host_stats, containers, key, pool=None):
+    args = [(rootfs, host_stats, container) for container in containers]
+
+    if pool:
+        all_stats = pool.map(_read_container_stats, args)
+    else:
+        all_stats = map(_read_container_stats, args)
+
+    # results come back in the containers order, whatever worker read them
+    for container, stats in zip(containers, all_stats):
         container[key] = stats
 
 
-def _get_container_stats(rootfs, container):
+def _read_container_stats(args):
+    """Module level so it can be pickled and sent to a process pool."""
+    rootfs, host_stats, container = args
+    return _get_container_stats(rootfs, host_stats, container)
+
+
+def _get_container_stats(rootfs, host_stats, container):
     cgroups = container.get("cgroups")
     pid = container.get("pid")
 
+    if cgroups_util.UNIFIED in cgroups:
+        return _get_unified_container_stats(rootfs, host_stats, cgroups[cgroups_util.UNIFIED], pid)
+
     stats = {
+        "timestamp": time.time(),
         "network": cgroups_util.get_net_stats(rootfs, pid),
         "disk": cgroups_util.get_blkio_stats(cgroups["blkio"], pid),
-        "cpu": cgroups_util.get_cpu_stats(rootfs, cgroups["cpuacct"], pid),
-        "memory": cgroups_util.get_memory_stats(rootfs, cgroups["memory"], pid),
+        "cpu": cgroups_util.get_cpu_stats(host_stats, cgroups["cpuacct"], pid),
+        "memory": cgroups_util.get_memory_stats(host_stats, cgroups["memory"], pid),
+    }
+
+    return stats
+
+
+def _get_unified_container_stats(rootfs, host_stats, cgroup_path, pid):
+    """cgroup v2 stats, with the same names as the cgroup v1 ones."""
+    stats = {
+        "timestamp": time.time(),
+        "network": cgroups_util.get_net_stats(rootfs, pid),
+        "disk": cgroups_util.get_io_stats(cgroup_path, pid),
+        "cpu": cgroups_util.get_unified_cpu_stats(host_stats, cgroup_path, pid),
+        "memory": cgroups_util.get_unified_memory_stats(host_stats, cgroup_path, pid),
     }
 
     return stats
 
 
-def _get_container_metrics(finger, now_stats, prev_stats, interval):
-    base_path = finger + '.base'
-    metrics = {base_path + '.count': 1}
+def _get_container_rate_stats(rootfs, host_stats, container):
+    """Only the stats behind the sampled rates, cpu and network."""
+    cgroups = container.get("cgroups")
+    pid = container.get("pid")
 
-    metrics.update(_get_disk_metrics(base_path, now_stats.get("disk"), prev_stats.get("disk"), interval))
-    metrics.update(_get_cpu_metrics(base_path, now_stats.get("cpu"), prev_stats.get("cpu"), interval))
-    metrics.update(_get_memory_metrics(base_path, now_stats.get("memory")))
-    metrics.update(_get_network_metrics(base_path, now_stats.get("network"), prev_stats.get("network"), interval))
+    if cgroups_util.UNIFIED in cgroups:
+        cpu_stats = cgroups_util.get_unified_cpu_stats(host_stats, cgroups[cgroups_util.UNIFIED], pid)
+    else:
+        cpu_stats = cgroups_util.get_cpu_stats(host_stats, cgroups["cpuacct"], pid)
 
-    return metrics
+    stats = {
+        "timestamp": time.time(),
+        "network": cgroups_util.get_net_stats(rootfs, pid),
+        "cpu": cpu_stats,
+    }
 
+    return stats
 
-"""
-disk metrics
-"""
 
+class Sample(object):
+    """The counters of a container snapshot which the rates are computed from.
+
+    Each group of counters is a tuple in the order of its *_stats names, with None for the
+    counters which couldn't be read. cpu is None unless all its counters were read.
+    """
+
+    __slots__ = ("timestamp", "cores", "cpu", "disk", "network")
+
+    def __init__(self, stats):
+        cpu_stats = stats.get("cpu") or {}
+        self.timestamp = stats.get("timestamp")
+        self.cores = cpu_stats.get("cores")
+        self.cpu = _get_counters(cpu_stats, cpu_stats_names)
+        self.disk = _get_counters(stats.get("disk") or {}, disk_stats_names)
+        self.network = _get_counters(stats.get("network") or {}, network_stats_names)
+
+        if None in self.cpu or self.cores is None:
+            self.cpu = None
+
+
+def _get_counters(stats, names):
+    return tuple(stats.get(name) for name in names)
+
+
+class ContainerPaths(object):
+    """The graphite paths of a container metrics, built once when the container is first seen.
+
+    Paths follow the order of the *_stats names, ex: disk[0] is <finger>.base.disk.read_count
+    and disk_per_sec[0] is <finger>.base.disk.read_count_per_sec.
+    """
 
-def _get_disk_metrics(base_path, now_stats, prev_stats, interval):
-    disk_path = base_path + '.disk'
+    __slots__ = ("base", "count", "memory", "cpu", "disk", "disk_per_sec", "network", "network_per_sec",
+                 "net_download", "net_upload", "aggregates")
+
+    def __init__(self, finger):
+        self.base = finger + '.base'
+        self.count = self.base + '.count'
+        self.memory = {}
+        self.cpu = tuple(self.base + '.cpu' + suffix for suffix in cpu_suffixes)
+        self.disk = tuple('%s.disk.%s' % (self.base, name) for name in disk_stats_names)
+        self.disk_per_sec = tuple(path + '_per_sec' for path in self.disk)
+        self.network = tuple('%s.network.%s' % (self.base, name) for name in network_stats_names)
+        self.network_per_sec = tuple(path + '_per_sec' for path in self.network)
+        self.net_download = self.base + '.net_download'
+        self.net_upload = self.base + '.net_upload'
+        self.aggregates = {}
+
+    def get_memory_path(self, metric):
+        path = self.memory.get(metric)
+
+        if path is None:
+            if metric in ["memory", "swap"]:
+                path = self.base + '.' + metric
+            else:
+                path = self.base + '.vmem.' + metric
+            self.memory[metric] = path
+
+        return path
+
+    def get_aggregate_paths(self, path):
+        paths = self.aggregates.get(path)
+
+        if paths is None:
+            paths = self.aggregates[path] = tuple(path + suffix for suffix in aggregate_suffixes)
+
+        return paths
+
+
+def _get_rate_metrics(paths, now_sample, prev_sample, interval):
     metrics = {}
 
-    for metric, value in now_stats.iteritems():
-        path = disk_path + '.' + metric
-        per_sec_path = path + '_per_sec'
+    _add_cpu_metrics(metrics, paths, now_sample, prev_sample, interval)
+    _add_network_metrics(metrics, paths, now_sample.network, prev_sample.network, interval)
+
+    return metrics
+
+
+def _get_aggregate_metrics(paths, buffers):
+    """avg/min/max/p95 of the sampled rates, the buffers are emptied for the next collection."""
+    metrics = {}
+
+    for path, buffer in buffers.iteritems():
+        aggregates = buffer.get_aggregates()
+        buffer.clear()
+
+        if aggregates:
+            for aggregate_path, value in zip(paths.get_aggregate_paths(path), aggregates):
+                metrics[aggregate_path] = value
+
+    return metrics
+
+
+def _get_container_metrics(paths, memory_stats, now_sample, prev_sample):
+    metrics = {paths.count: 1}
+
+    _add_memory_metrics(metrics, paths, memory_stats)
+    _add_counter_metrics(metrics, paths, now_sample)
+
+    # the container was just discovered, rates will be available on the next cycle
+    if not prev_sample:
+        return metrics
+
+    interval = now_sample.timestamp - prev_sample.timestamp
+    if interval <= 0:
+        return metrics
 
-        metrics[path] = value
-        metrics[per_sec_path] = (float(value) - float(prev_stats.get(metric))) / interval
+    _add_disk_metrics(metrics, paths, now_sample.disk, prev_sample.disk, interval)
+    _add_cpu_metrics(metrics, paths, now_sample, prev_sample, interval)
+    _add_network_metrics(metrics, paths, now_sample.network, prev_sample.network, interval)
 
     return metrics
 
 
+def _add_counter_metrics(metrics, paths, now_sample):
+    """The raw counters and the cores, which don't need a previous sample."""
+    for index, value in enumerate(now_sample.disk):
+        if value is not None:
+            metrics[paths.disk[index]] = value
+
+    for index, value in enumerate(now_sample.network):
+        if value is not None:
+            metrics[paths.network[index]] = value
+
+    if now_sample.cpu is not None:
+        metrics[paths.cpu[CORES]] = now_sample.cores
+
+
+"""
+disk metrics
+"""
+
+disk_stats_names = ("read_count", "write_count", "read_bytes", "write_bytes")
+
+
+def _add_disk_metrics(metrics, paths, now_counters, prev_counters, interval):
+    for index, value in enumerate(now_counters):
+        prev_value = prev_counters[index]
+        if value is not None and prev_value is not None:
+            metrics[paths.disk_per_sec[index]] = (float(value) - float(prev_value)) / interval
+
+
 """
 cpu metrics
 """
 
+cpu_stats_names = ("total", "usage", "system", "user")
+cpu_suffixes = ("", ".system", ".user", ".cores")
+
+# index of the paths in ContainerPaths.cpu, the first three match cpu_stats_names[1:]
+USAGE, SYSTEM, USER, CORES = range(4)
+
 
-def _get_cpu_metrics(base_path, now_stats, prev_stats, interval):
-    cpu_path = base_path + '.cpu'
-    num_cores = now_stats.get('cores')
+def _add_cpu_metrics(metrics, paths, now_sample, prev_sample, interval):
+    if now_sample.cpu is None or prev_sample.cpu is None:
+        return
 
-    system_percent, user_percent, usage_percent = 0.0, 0.0, 0.0
-    total_delta = now_stats.get('total') - prev_stats.get('total')
+    num_cores = now_sample.cores
+    percents = [0.0, 0.0, 0.0]
+    total_delta = now_sample.cpu[0] - prev_sample.cpu[0]
 
     if total_delta > 0:
         total_delta_per_sec = float(total_delta) / interval
 
-        usage_delta = now_stats.get('usage') - prev_stats.get('usage')
-        if usage_delta > 0:
-            usage_delta_per_sec = float(usage_delta) / interval
-            usage_percent = usage_delta_per_sec / total_delta_per_sec * num_cores * 100
-
-        system_delta = now_stats.get("system") - prev_stats.get('system')
-        if system_delta > 0:
-            system_delta_per_sec = float(system_delta) / interval
-            system_percent = system_delta_per_sec / total_delta_per_sec * num_cores * 100
-
-        user_delta = now_stats.get('user') - prev_stats.get('user')
-        if user_delta > 0:
-            user_delta_per_sec = float(user_delta) / interval
-            user_percent = user_delta_per_sec / total_delta_per_sec * num_cores * 100
-
-    metrics = {
-        cpu_path + '.cores': num_cores,
-        cpu_path + '.user': user_percent,
-        cpu_path + '.system': system_percent,
-        cpu_path: usage_percent,
-    }
+        # usage, system and user
+        for index in range(3):
+            delta = now_sample.cpu[index + 1] - prev_sample.cpu[index + 1]
+            if delta > 0:
+                delta_per_sec = float(delta) / interval
+                percents[index] = delta_per_sec / total_delta_per_sec * num_cores * 100
 
-    return metrics
+    metrics[paths.cpu[USAGE]] = percents[USAGE]
+    metrics[paths.cpu[SYSTEM]] = percents[SYSTEM]
+    metrics[paths.cpu[USER]] = percents[USER]
 
 
 """
@@ -129,40 +428,33 @@ memory metrics
 """
 
 
-def _get_memory_metrics(base_path, stats):
-    memory_path = base_path + '.vmem'
-
-    metrics = {}
+def _add_memory_metrics(metrics, paths, stats):
     for metric, value in stats.iteritems():
-        if metric in ["memory", "swap"]:
-            path = base_path + '.' + metric
-        else:
-            path = memory_path + '.' + metric
-        metrics[path] = value
-
-    return metrics
+        metrics[paths.get_memory_path(metric)] = value
 
 
 """
 network metrics
 """
 
+network_stats_names = ("bytes_recv", "packets_recv", "errin", "dropin",
+                       "bytes_sent", "packets_sent", "errout", "dropout")
 
-def _get_network_metrics(base_path, now_stats, prev_stats, interval):
-    network_path = base_path + '.network'
-    metrics = {}
+# index of the bytes counters in network_stats_names
+BYTES_RECV, BYTES_SENT = 0, 4
 
-    for metric, value in now_stats.iteritems():
-        path = network_path + '.' + metric
-        per_sec_path = path + '_per_sec'
 
-        metrics[path] = value
-        metrics[per_sec_path] = (float(value) - float(prev_stats.get(metric))) / interval
+def _add_network_metrics(metrics, paths, now_counters, prev_counters, interval):
+    for index, value in enumerate(now_counters):
+        prev_value = prev_counters[index]
+        if value is None or prev_value is None:
+            continue
 
-        if metric == 'bytes_recv':
-            metrics[base_path + '.net_download'] = metrics[per_sec_path] / 1024
+        per_sec = (float(value) - float(prev_value)) / interval
+        metrics[paths.network_per_sec[index]] = per_sec
 
-        elif metric == 'bytes_sent':
-            metrics[base_path + '.net_upload'] = metrics[per_sec_path] / 1024
+        if index == BYTES_RECV:
+            metrics[paths.net_download] = per_sec / 1024
 
-    return metrics
+        elif index == BYTES_SENT:
+            metrics[paths.net_upload] = per_sec / 1024
@@ -1,11 +1,12 @@
 import logging
 import docker
 import socket
-import itertools
 import uuid
 import os
 import re
 
+import proc_util
+
 logger = logging.getLogger("DOCKERUTIL")
 
 UUID_HASH = uuid.UUID("12345678123456781234567812345678")
@@ -34,11 +35,31 @@ docker_client = docker.from_env(
 def list_containers():
     """Return a list of running containers."""
     containers = docker_client.containers.list()
+    return filter(is_monitored, containers)
+
+
+def get_container(container_id):
+    return docker_client.containers.get(container_id)
+
+
+def get_events(since=None):
+    """Return a blocking generator of the decoded containers events.
+
+    The events stream is idle most of the time, it gets its own client without the read timeout.
+    """
+    events_client = docker.from_env(
+        assert_hostname=False,
+        version="auto",
+        timeout=None,
+    )
+    return events_client.events(since=since, filters={"type": "container"}, decode=True)
 
+
+def is_monitored(container):
     if is_k8s:
-        return filter(_filter_kube_container, containers)
+        return _filter_kube_container(container)
 
-    return filter(_filter_host_container, containers)
+    return _filter_host_container(container)
 
 
 def get_container_hashes(containers):
@@ -58,6 +79,10 @@ def get_pid(container):
     return container.attrs.get("State", {}).get("Pid", "") or ""
 
 
+def is_running(container):
+    return container.attrs.get("State", {}).get("Running", False)
+
+
 def get_processes(container):
     """Get and group/count the processes running inside the container."""
     docker_processes = container.top().get("Processes", []) or []
@@ -67,13 +92,7 @@ def get_processes(container):
 
     processes = map(extract_docker_processes, docker_processes)
 
-    def serialize(name, group):
-        return "%s:%s" % (name, len(list(group)))
-
-    processes_out = list(
-        (serialize(k, v) for k, v in itertools.groupby(processes)))
-
-    return processes_out
+    return proc_util.group_processes(processes)
 
 
 def get_ips(container):
@@ -0,0 +1,145 @@
+import errno
+import logging
+import os
+import resource
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("FILECACHE")
+
+MAX_FILES = 8192
+# descriptors left for the sockets, pipes and files opened outside of the cache
+RESERVED_FILES = 256
+READ_SIZE = 64 * 1024
+
+
+class FileCache(object):
+    """Keep the stat files open between snapshots and read them again from offset 0.
+
+    cgroup and /proc stat files are generated on read, seeking back to the start of an
+    already open descriptor returns fresh content without the open/close syscalls.
+    The least recently read files over `max_files` are closed by `trim`, which (like
+    `evict`) must only be called between snapshots, when no worker is reading. Until then,
+    the files which don't fit in the cache are opened and closed on every read.
+
+    By default `max_files` is derived from the open files limit of the process.
+    """
+
+    def __init__(self, max_files=None):
+        self.max_files = max_files if max_files is not None else get_max_files()
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reads = 0
+        self.uncached = 0
+
+    def read(self, path):
+        """Return the whole content of path, raise OSError like os.open if it can't be read."""
+        fd = self._get_fd(path)
+        if fd is None:
+            return _read_path(path)
+
+        try:
+            return _read_fd(fd)
+
+        except OSError as ex:
+            # ENODEV, ESRCH...: the cgroup or the process behind that descriptor is gone
+            logger.debug("%s can't be read again: %s" % (path, ex))
+
+        # try once more with a fresh descriptor, in case the file was created again
+        self._close(path)
+        fd = self._get_fd(path)
+        if fd is None:
+            return _read_path(path)
+
+        return _read_fd(fd)
+
+    def evict(self, prefix):
+        """Close all the files under prefix, ex: the cgroup directory of a removed container."""
+        for path in [p for p in self.files if p.startswith(prefix)]:
+            self._close(path)
+
+    def trim(self):
+        while len(self.files) > self.max_files:
+            path, fd = self.files.popitem(last=False)
+            _close_fd(fd)
+
+    def close_all(self):
+        for path in self.files.keys():
+            self._close(path)
+
+    def get_stats(self):
+        return {"files": len(self.files), "opened": self.opened, "reads": self.reads, "uncached": self.uncached}
+
+    def _get_fd(self, path):
+        with self.lock:
+            fd = self.files.pop(path, None)
+            self.reads += 1
+
+            if fd is None:
+                # full, the least recently read files can only be closed by the next trim
+                if len(self.files) >= self.max_files:
+                    self.uncached += 1
+                    return None
+
+                fd = os.open(path, os.O_RDONLY)
+                self.opened += 1
+
+            # most recently read files go last
+            self.files[path] = fd
+            return fd
+
+    def _close(self, path):
+        with self.lock:
+            fd = self.files.pop(path, None)
+
+        if fd is not None:
+            _close_fd(fd)
+
+
+def get_max_files():
+    """Raise the soft open files limit up to the hard one if needed, and return what fits under it."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = MAX_FILES + RESERVED_FILES
+
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        raised = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (raised, hard))
+            soft = raised
+        except (ValueError, resource.error) as ex:
+            logger.warn("can't raise the open files limit to %d: %s" % (raised, ex))
+
+    if soft == resource.RLIM_INFINITY:
+        return MAX_FILES
+
+    return max(0, min(MAX_FILES, soft - RESERVED_FILES))
+
+
+def _read_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return _read_fd(fd)
+    finally:
+        _close_fd(fd)
+
+
+def _read_fd(fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+
+    chunks = []
+    while True:
+        chunk = os.read(fd, READ_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+
+    return "".join(chunks)
+
+
+def _close_fd(fd):
+    try:
+        os.close(fd)
+    except OSError as ex:
+        if ex.errno != errno.EBADF:
+            raise
@@ -0,0 +1,140 @@
+import cPickle
+import logging
+import select
+import socket
+import struct
+import threading
+import time
+
+logger = logging.getLogger("GRAPHITE")
+
+PLAINTEXT_PORT = 2003
+PICKLE_PORT = 2004
+
+CONNECT_TIMEOUT = 5
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+
+# maximum size of a single send, in bytes for plaintext and in datapoints for pickle
+PLAINTEXT_CHUNK_SIZE = 64 * 1024
+PICKLE_CHUNK_SIZE = 500
+
+
+class GraphiteSender(object):
+    """Send datapoints to graphite over one long lived connection.
+
+    When the connection can't be established, the next attempts are delayed with an
+    exponential backoff (1s up to 60s) instead of connecting again on every send.
+    The sender can be shared between threads.
+    """
+
+    def __init__(self, host, port, use_pickle=False):
+        self.host = host
+        self.port = port
+        self.use_pickle = use_pickle
+        self.sock = None
+        self.backoff = 0
+        self.next_connect = 0
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+
+    def send(self, datapoints):
+        """Send a list of (path, value, timestamp) datapoints, raise socket.error on failure."""
+        if not datapoints:
+            return
+
+        if self.use_pickle:
+            payloads = _pickle_payloads(datapoints)
+        else:
+            payloads = _plaintext_payloads(datapoints)
+
+        with self.lock:
+            try:
+                sock = self._connect()
+                for payload in payloads:
+                    sock.sendall(payload)
+                    self.bytes_sent += len(payload)
+
+            except socket.error:
+                self.close()
+                raise
+
+            except Exception as ex:
+                # reconnect on the next send, the caller spools the datapoints as when graphite is down
+                self.close()
+                raise socket.error("graphite send failed: %s" % ex)
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def _connect(self):
+        if self.sock and not self._is_closed():
+            return self.sock
+
+        self.close()
+
+        now = time.time()
+        if now < self.next_connect:
+            raise socket.error("graphite %s:%s unavailable, next attempt in %.1fs"
+                               % (self.host, self.port, self.next_connect - now))
+
+        try:
+            logger.debug("connecting to graphite %s:%s" % (self.host, self.port))
+            self.sock = socket.create_connection((self.host, self.port), CONNECT_TIMEOUT)
+
+        except socket.error:
+            self.backoff = min(max(self.backoff * 2, MIN_BACKOFF), MAX_BACKOFF)
+            self.next_connect = now + self.backoff
+            raise
+
+        self.backoff = 0
+        return self.sock
+
+    def _is_closed(self):
+        """Carbon never writes to the socket, if it is readable the server closed it.
+
+        poll rather than select, which can't watch the fds above 1023 the file cache pushes it to.
+        """
+        try:
+            poller = select.poll()
+            poller.register(self.sock, select.POLLIN | select.POLLHUP | select.POLLERR)
+            events = poller.poll(0)
+            if not events:
+                return False
+
+            if events[0][1] & (select.POLLHUP | select.POLLERR):
+                return True
+
+            return not self.sock.recv(1)
+
+        except Exception:
+            return True
+
+
+def _plaintext_payloads(datapoints):
+    lines, size = [], 0
+
+    for path, value, timestamp in datapoints:
+        line = "%s %s %d\n" % (path, value, timestamp)
+        lines.append(line)
+        size += len(line)
+
+        if size >= PLAINTEXT_CHUNK_SIZE:
+            yield "".join(lines)
+            lines, size = [], 0
+
+    if lines:
+        yield "".join(lines)
+
+
+def _pickle_payloads(datapoints):
+    """Carbon pickle format: a 4 bytes length header then a pickled [(path, (timestamp, value))]."""
+    for i in xrange(0, len(datapoints), PICKLE_CHUNK_SIZE):
+        chunk = [(path, (timestamp, value)) for path, value, timestamp in datapoints[i:i + PICKLE_CHUNK_SIZE]]
+        payload = cPickle.dumps(chunk, protocol=2)
+        yield struct.pack("!L", len(payload)) + payload
@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+
+import requests
+
+import docker_util
+
+logger = logging.getLogger("HOSTFACTS")
+
+TTL = 300
+REFRESH_INTERVAL = 60
+
+HOST_FINGER = "host_finger"
+SYSTEM_UUID = "system_uuid"
+HOSTNAME = "hostname"
+
+
+def get_host_finger():
+    finger = requests.get("http://localhost:8000", timeout=5).text
+    # this endpoint returns the fingerprint with a newline, so strip whitespace
+    return finger.strip()
+
+
+def get_docker_hostname():
+    hostname = docker_util.get_host_hostname()
+    if not hostname:
+        raise Exception("docker hostname is unavailable")
+
+    return hostname
+
+
+class HostFacts(object):
+    """Cache the host finger, system uuid and docker hostname, they are valid for `ttl` seconds.
+
+    Once started, a background thread reloads them every `refresh_interval` seconds so
+    `get` doesn't wait on the network. A value which fails to load is dropped from the
+    cache, the next `get` tries to load it again.
+    """
+
+    def __init__(self, ttl=TTL, refresh_interval=REFRESH_INTERVAL):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.facts = {}
+        self.loaders = {
+            HOST_FINGER: get_host_finger,
+            SYSTEM_UUID: docker_util.get_system_uuid,
+            HOSTNAME: get_docker_hostname,
+        }
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._refresh, name="host-facts")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, name, *default):
+        """Return a cached fact, load it if expired. If it fails, return default or raise."""
+        with self.lock:
+            value, expires = self.facts.get(name, (None, 0))
+
+        if time.time() < expires:
+            return value
+
+        try:
+            return self._load(name)
+        except Exception:
+            if default:
+                return default[0]
+            raise
+
+    def invalidate(self, name):
+        with self.lock:
+            self.facts.pop(name, None)
+
+    def _load(self, name):
+        try:
+            value = self.loaders[name]()
+        except Exception as ex:
+            logger.warn("can't load the host %s: %s" % (name, ex))
+            self.invalidate(name)
+            raise
+
+        with self.lock:
+            self.facts[name] = (value, time.time() + self.ttl)
+
+        return value
+
+    def _refresh(self):
+        while True:
+            time.sleep(self.refresh_interval)
+
+            for name in self.loaders:
+                try:
+                    self._load(name)
+                except Exception:
+                    continue
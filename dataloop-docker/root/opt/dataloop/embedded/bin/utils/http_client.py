@@ -0,0 +1,96 @@
+import logging
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("HTTPCLIENT")
+
+CONCURRENCY = 10
+RETRIES = 2
+BACKOFF = 0.5
+TIMEOUT = 5
+
+# the server asked to try again later
+RETRY_STATUSES = (408, 429)
+
+
+class HttpClient(object):
+    """Send requests over one keep-alive session, at most `concurrency` of them at a time.
+
+    Server errors (5xx), 408 and 429 responses, connection errors and timeouts are retried
+    `retries` times with a jittered exponential backoff. A request which still fails is logged
+    and counted, it never stops the other requests. Latency and errors are counted per endpoint.
+    """
+
+    def __init__(self, concurrency=CONCURRENCY, retries=RETRIES, timeout=TIMEOUT):
+        self.retries = retries
+        self.timeout = timeout
+
+        # one connection pool per host, as large as the number of concurrent requests
+        adapter = HTTPAdapter(pool_maxsize=concurrency)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.pool = ThreadPool(concurrency)
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def request(self, endpoint, method, url, **kwargs):
+        """Send a request, return the last response or None if there wasn't any."""
+        response = None
+
+        for attempt in xrange(self.retries + 1):
+            if attempt:
+                time.sleep(BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+            started = time.time()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                retry = response.status_code >= 500 or response.status_code in RETRY_STATUSES
+                error = retry and "status %s" % response.status_code
+
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                response, error = None, ex
+
+            failed = error or not response.ok
+            self._count(endpoint, time.time() - started, failed, attempt)
+            if not error:
+                break
+
+        if response is None or not response.ok:
+            logger.error("request failed: %s %s - %s" % (method, url, error or response.status_code))
+
+        return response
+
+    def request_many(self, endpoint, method, requests_kwargs):
+        """Send a request for each (url, kwargs), return the responses in the same order."""
+        def send(request_kwargs):
+            url, kwargs = request_kwargs
+            try:
+                return self.request(endpoint, method, url, **kwargs)
+            except Exception as ex:
+                logger.error("request failed: %s %s - %s" % (method, url, ex), exc_info=True)
+
+        return self.pool.map(send, requests_kwargs)
+
+    def get_stats(self):
+        with self.lock:
+            return dict((endpoint, dict(stats)) for endpoint, stats in self.stats.items())
+
+    def _count(self, endpoint, latency, failed, attempt):
+        with self.lock:
+            stats = self.stats.setdefault(endpoint, {
+                "requests": 0, "errors": 0, "retries": 0, "latency": 0.0, "max_latency": 0.0,
+            })
+            stats["requests"] += 1
+            stats["latency"] += latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+            if failed:
+                stats["errors"] += 1
+            if attempt:
+                stats["retries"] += 1
@@ -0,0 +1,79 @@
+import BaseHTTPServer
+import SocketServer
+import logging
+import socket
+import threading
+import urlparse
+
+logger = logging.getLogger("HTTPSERVER")
+
+PORT = 8080
+# only local clients by default, there is no authentication
+HOST = "127.0.0.1"
+
+
+class HttpServer(object):
+    """Serve GET requests from a background thread.
+
+    routes maps a path to a handler called with the query string parameters, as a dict of
+    single values, and which returns (status, content type, body).
+    """
+
+    def __init__(self, port=PORT, routes=None, host=HOST):
+        self.host = host
+        self.port = port
+        self.routes = routes or {}
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """Return False if the server couldn't listen, ex: the port is already used."""
+        routes = self.routes
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse.urlparse(self.path)
+                handler = routes.get(url.path)
+
+                if handler is None:
+                    self._respond(404, "text/plain", "not found\n")
+                    return
+
+                params = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).iteritems())
+                try:
+                    status, content_type, body = handler(params)
+                except ValueError as ex:
+                    status, content_type, body = 400, "text/plain", "%s\n" % ex
+                except Exception as ex:
+                    logger.error("%s failed: %s" % (self.path, ex), exc_info=True)
+                    status, content_type, body = 500, "text/plain", "internal error\n"
+
+                self._respond(status, content_type, body)
+
+            def _respond(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except socket.error as ex:
+            logger.error("can't listen on %s:%d, the http endpoints are disabled: %s" % (self.host, self.port, ex))
+            return False
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name="http-server")
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("listening on %s:%d" % (self.host, self.port))
+        return True
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
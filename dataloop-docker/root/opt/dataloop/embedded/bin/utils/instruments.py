@@ -0,0 +1,41 @@
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "collector"
+
+
+class Instruments(object):
+    """Timers, counters and gauges about the collector itself.
+
+    Timers keep the duration in ms of the last run of a phase, counters are totals since
+    the process started and gauges the last value set. The instruments can be shared between
+    threads, they are published with the containers metrics under the host finger.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.gauge(name + ".time", (time.time() - start) * 1000)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def get_metrics(self, host_finger):
+        """Return {path: value}, ex: <host_finger>.collector.metrics.send.time"""
+        base_path = "%s.%s." % (host_finger, PREFIX)
+
+        with self.lock:
+            return dict((base_path + name, value) for name, value in self.values.iteritems())
@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+
+import docker
+
+import docker_util
+
+logger = logging.getLogger("INVENTORY")
+
+RESYNC_INTERVAL = 300
+RECONNECT_DELAY = 5
+
+update_events = ["start", "rename", "update"]
+remove_events = ["die", "destroy"]
+
+
+class ContainerInventory(object):
+    """Keep the set of running containers up to date from the docker events stream.
+
+    The containers are listed once, then every start/die/destroy/rename/update event
+    updates the set. A full list is still done every `resync_interval` seconds and
+    whenever the events stream was lost, in case some events were missed.
+    """
+
+    def __init__(self, resync_interval=RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self.containers = {}
+        self.lock = threading.Lock()
+        # the agents and metrics threads may both resync
+        self.resync_lock = threading.Lock()
+        self.last_sync = 0
+        self.last_event = 0
+        self.stale = True
+        self.thread = None
+        # the containers changed by the events while a resync lists them
+        self.changed = None
+
+    def start(self):
+        try:
+            self.resync()
+        except Exception as ex:
+            # still stale, the next list_containers retries
+            logger.error("can't list the containers: %s" % ex)
+
+        self.thread = threading.Thread(target=self._watch_events, name="docker-events")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def list_containers(self):
+        """Return a list of running containers."""
+        if self.stale or time.time() - self.last_sync > self.resync_interval:
+            self.resync()
+
+        with self.lock:
+            return self.containers.values()
+
+    def resync(self):
+        with self.resync_lock:
+            self._resync()
+
+    def _resync(self):
+        logger.debug("listing all containers")
+
+        # the events stream replays from here, nothing is missed during the list
+        last_sync = int(time.time())
+        with self.lock:
+            self.changed = set()
+
+        try:
+            containers = docker_util.list_containers()
+        except Exception:
+            with self.lock:
+                self.changed = None
+            raise
+
+        with self.lock:
+            listed = dict((c.id, c) for c in containers)
+
+            # the list may predate an event handled meanwhile, ex: a die, keep what the event did
+            for container_id in self.changed:
+                if container_id in self.containers:
+                    listed[container_id] = self.containers[container_id]
+                else:
+                    listed.pop(container_id, None)
+
+            self.containers = listed
+            self.changed = None
+            self.last_sync = last_sync
+            self.stale = False
+
+    def _watch_events(self):
+        while True:
+            try:
+                since = max(self.last_sync, self.last_event)
+                for event in docker_util.get_events(since=since):
+                    self._handle_event(event)
+                    self.last_event = event.get("time", self.last_event)
+
+            except Exception as ex:
+                logger.error("docker events stream failed: %s" % ex, exc_info=True)
+
+            # some events may have been missed while disconnected
+            self.stale = True
+            time.sleep(RECONNECT_DELAY)
+
+    def _handle_event(self, event):
+        action = event.get("Action") or event.get("status")
+        container_id = event.get("id") or event.get("Actor", {}).get("ID")
+
+        if action in update_events:
+            self._update_container(container_id)
+
+        elif action in remove_events:
+            self._remove_container(container_id)
+
+    def _update_container(self, container_id):
+        try:
+            container = docker_util.get_container(container_id)
+        except docker.errors.NotFound:
+            self._remove_container(container_id)
+            return
+        except Exception as ex:
+            # it may still be running, the next list_containers lists them all again
+            logger.warn("container %s can't be inspected: %s" % (container_id, ex))
+            self.stale = True
+            return
+
+        if not docker_util.is_running(container) or not docker_util.is_monitored(container):
+            self._remove_container(container_id)
+            return
+
+        logger.debug("container %s updated" % container_id)
+        with self.lock:
+            self.containers[container_id] = container
+            self._mark_changed(container_id)
+
+    def _remove_container(self, container_id):
+        with self.lock:
+            self._mark_changed(container_id)
+            if self.containers.pop(container_id, None):
+                logger.debug("container %s removed" % container_id)
+
+    def _mark_changed(self, container_id):
+        if self.changed is not None:
+            self.changed.add(container_id)
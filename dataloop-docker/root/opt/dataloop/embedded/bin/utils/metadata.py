@@ -0,0 +1,74 @@
+import logging
+
+import docker_util
+
+logger = logging.getLogger("METADATA")
+
+env_tag_keys = ['ENV', 'APP_NAME']
+
+
+class MetadataCache(object):
+    """Derive the metadata of each container once, from its config which never changes.
+
+    The tags also depend on the host finger and hostname, they are only built again when
+    one of those changes. Containers which are gone are evicted by `prune`. The agents and
+    metrics threads share it, at worst a metadata is derived twice.
+    """
+
+    def __init__(self):
+        self.metadata = {}
+
+    def get(self, container):
+        """Return {'finger', 'image', 'hostname', 'labels', 'env_tags'} for a container."""
+        metadata = self.metadata.get(container.id)
+
+        if metadata is None:
+            metadata = {
+                'finger': docker_util.get_hash(container),
+                'image': docker_util.get_image(container),
+                'hostname': docker_util.get_container_hostname(container),
+                'labels': docker_util.get_labels(container),
+                'env_tags': _get_env_tags(container),
+                'tags': None,
+            }
+            self.metadata[container.id] = metadata
+
+        return metadata
+
+    def get_finger(self, container):
+        return self.get(container)['finger']
+
+    def get_tags(self, container, host_finger, host_hostname):
+        metadata = self.get(container)
+        host = (host_finger, host_hostname)
+
+        if metadata['tags'] is None or metadata['tags'][0] != host:
+            metadata['tags'] = (host, _build_tags(metadata, host_finger, host_hostname))
+
+        return metadata['tags'][1]
+
+    def prune(self, container_ids):
+        container_ids = set(container_ids)
+        for container_id in self.metadata.keys():
+            if container_id not in container_ids:
+                self.metadata.pop(container_id, None)
+
+
+def _build_tags(metadata, host_finger, host_hostname):
+    tags = ["all", "docker"]
+
+    tags.append("container:%s" % metadata['hostname'])
+    tags.append("parent:%s" % host_finger)
+    tags.append(metadata['image'])
+    tags.append(host_hostname)
+    tags.append(metadata['hostname'])
+    tags += metadata['env_tags']
+    tags += metadata['labels']
+
+    sanitized = [t.replace('/', ':') for t in set(filter(None, tags))]
+    return ','.join(sanitized)
+
+
+def _get_env_tags(container):
+    container_env_vars = docker_util.get_env_variables(container)
+    return [container_env_vars[key] for key in container_env_vars if key in env_tag_keys]
@@ -0,0 +1,86 @@
+import fnmatch
+import threading
+import time
+from array import array
+
+RETENTION = 600
+
+
+class Series(object):
+    """Timestamps and values of one metric, in two compact arrays."""
+
+    __slots__ = ("timestamps", "values")
+
+    def __init__(self):
+        self.timestamps = array("l")
+        self.values = array("d")
+
+    def append(self, timestamp, value):
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+
+    def expire(self, oldest):
+        expired = 0
+        while expired < len(self.timestamps) and self.timestamps[expired] < oldest:
+            expired += 1
+
+        if expired:
+            del self.timestamps[:expired]
+            del self.values[:expired]
+
+        return len(self.timestamps)
+
+    def get_points(self, since=0):
+        return [[t, v] for t, v in zip(self.timestamps, self.values) if t >= since]
+
+
+class MetricStore(object):
+    """The metrics published in the last `retention` seconds, indexed by finger and metric path.
+
+    A metric path is split on its first dot, ex: <finger>.base.cpu is the base.cpu metric of
+    <finger>. The store is written by the metrics loop and read from the http server threads.
+    """
+
+    def __init__(self, retention=RETENTION):
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.fingers = {}
+
+    def add(self, datapoints):
+        """Add a list of (path, value, timestamp) datapoints, drop the ones older than the retention."""
+        with self.lock:
+            for path, value, timestamp in datapoints:
+                finger, _, metric = path.partition(".")
+                series = self.fingers.setdefault(finger, {}).get(metric)
+
+                if series is None:
+                    series = self.fingers[finger][metric] = Series()
+                series.append(timestamp, value)
+
+            self._expire(time.time() - self.retention)
+
+    def query(self, finger_prefix="", pattern="*", since=0):
+        """Return {finger: {metric: [[timestamp, value], ...]}} for the matching fingers and metrics."""
+        result = {}
+
+        with self.lock:
+            for finger, metrics in self.fingers.iteritems():
+                if not finger.startswith(finger_prefix):
+                    continue
+
+                for metric, series in metrics.iteritems():
+                    if fnmatch.fnmatchcase(metric, pattern):
+                        points = series.get_points(since)
+                        if points:
+                            result.setdefault(finger, {})[metric] = points
+
+        return result
+
+    def _expire(self, oldest):
+        for finger, metrics in self.fingers.items():
+            for metric, series in metrics.items():
+                if not series.expire(oldest):
+                    del metrics[metric]
+
+            if not metrics:
+                del self.fingers[finger]
@@ -0,0 +1,105 @@
+import itertools
+import logging
+import os
+
+import cgroups_util
+
+logger = logging.getLogger("PROCUTIL")
+
+
+class ProcessInventory(object):
+    """List the containers processes from the host /proc instead of `docker top`.
+
+    The pids of a container come from the cgroup.procs file of its cgroup, the process
+    names from /proc/<pid>/cmdline, read once for all the containers. A container
+    processes list is only built again when its set of pids changes.
+
+    cgroup.procs only lists the pids visible in our pid namespace: when the container
+    init pid isn't there (no --pid=host), `get_processes` returns None for that container.
+    """
+
+    def __init__(self, rootfs):
+        self.rootfs = rootfs
+        self.resolver = cgroups_util.CgroupResolver(rootfs)
+        self.processes = {}
+
+    def refresh(self, containers):
+        """Read the processes of containers, a list of (container_id, pid)."""
+        try:
+            self.resolver.refresh_mountpoints()
+        except EnvironmentError as ex:
+            logger.debug("can't find the cgroups mountpoints: %s" % ex)
+
+        pids = {}
+        for container_id, pid in containers:
+            container_pids = self._read_container_pids(container_id, pid)
+            if pid in container_pids:
+                pids[container_id] = container_pids
+
+        # the names are only read for the containers whose pids changed
+        changed = [container_id for container_id, container_pids in pids.items()
+                   if self.processes.get(container_id, (None, None))[0] != container_pids]
+        names = self._read_names(set(itertools.chain.from_iterable(pids[c] for c in changed)))
+
+        processes = {}
+        for container_id, container_pids in pids.items():
+            if container_id in changed:
+                container_names = [names[p] for p in sorted(container_pids) if p in names]
+                processes[container_id] = (container_pids, group_processes(container_names))
+            else:
+                processes[container_id] = self.processes[container_id]
+
+        logger.debug("processes read for %d containers out of %d" % (len(changed), len(containers)))
+
+        self.processes = processes
+        self.resolver.prune(containers)
+
+    def get_processes(self, container_id):
+        """Return the grouped processes of a container, None if they couldn't be read."""
+        _, processes = self.processes.get(container_id, (None, None))
+        return processes
+
+    def _read_container_pids(self, container_id, pid):
+        try:
+            cgroups = self.resolver.get_container_cgroups(container_id, pid)
+            cgroup_path = cgroups.get(cgroups_util.UNIFIED) or cgroups.get("memory")
+
+            if not cgroup_path:
+                return frozenset()
+
+            with open(os.path.join(cgroup_path, "cgroup.procs")) as fp:
+                return frozenset(int(p) for p in fp.read().split())
+
+        except (EnvironmentError, ValueError) as ex:
+            logger.debug("can't read the processes of %s: %s" % (container_id, ex))
+            return frozenset()
+
+    def _read_names(self, pids):
+        """Name the processes like the CMD column of `ps -ef`, [comm] for kernel threads."""
+        names = {}
+
+        for pid in pids:
+            proc_path = os.path.join(self.rootfs, "proc", str(pid))
+            try:
+                with open(os.path.join(proc_path, "cmdline")) as fp:
+                    cmdline = fp.read().rstrip("\0").replace("\0", " ")
+
+                if not cmdline:
+                    with open(os.path.join(proc_path, "comm")) as fp:
+                        cmdline = "[%s]" % fp.read().strip()
+
+                names[pid] = cmdline
+
+            except IOError:
+                # the process exited since cgroup.procs was read
+                continue
+
+        return names
+
+
+def group_processes(names):
+    """Group/count the consecutive processes with the same name, ex: ["nginx:4", "sh:1"]."""
+    def serialize(name, group):
+        return "%s:%s" % (name, len(list(group)))
+
+    return list((serialize(k, v) for k, v in itertools.groupby(names)))
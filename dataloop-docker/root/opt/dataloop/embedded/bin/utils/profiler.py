@@ -0,0 +1,54 @@
+import cProfile
+import logging
+import os
+import pstats
+
+logger = logging.getLogger("PROFILER")
+
+PROFILE_PATH = "/tmp/dataloop-%s-%d.prof"
+TOP = 10
+
+# the modules whose functions are summarized in the logs
+summary_modules = ["cgroups_util", "docker_util", "api"]
+
+
+def profile(name, task, cycles, top=TOP):
+    """Wrap task to run it under cProfile for its first `cycles` runs.
+
+    Then the aggregated stats are written to /tmp/dataloop-<name>-<pid>.prof, to be loaded
+    with pstats, and the `top` functions of each summarized module are logged. Only the
+    thread running the task is profiled, not the worker pools.
+    """
+    profiler = cProfile.Profile()
+    state = {"remaining": cycles}
+
+    def run(*args):
+        if state["remaining"] <= 0:
+            return task(*args)
+
+        profiler.enable()
+        try:
+            return task(*args)
+        finally:
+            profiler.disable()
+            state["remaining"] -= 1
+            if state["remaining"] == 0:
+                _report(name, profiler, top)
+
+    return run
+
+
+def _report(name, profiler, top):
+    path = PROFILE_PATH % (name, os.getpid())
+    profiler.dump_stats(path)
+    logger.info("%s profile written to %s" % (name, path))
+
+    stats = pstats.Stats(profiler).stats
+    for module in summary_modules:
+        functions = [(key, value) for key, value in stats.items()
+                     if os.path.splitext(os.path.basename(key[0]))[0] == module]
+        functions.sort(key=lambda f: f[1][3], reverse=True)
+
+        for (filename, lineno, function), (_, calls, tottime, cumtime, _) in functions[:top]:
+            logger.info("%s %s.%s:%d: %d calls, %.3fs total, %.3fs cumulative" % (
+                name, module, function, lineno, calls, tottime, cumtime))
@@ -0,0 +1,71 @@
+import re
+import threading
+
+PREFIX = "dataloop_"
+
+name_pattern = re.compile("[^a-zA-Z0-9_:]")
+
+
+class PrometheusExporter(object):
+    """Keep the last metrics of each container and their rendering in the prometheus text format.
+
+    The body is rendered once by `render`, after each collection, and served as is by
+    `get_body` however often it is scraped. A metric path <finger>.base.cpu.user becomes
+    dataloop_base_cpu_user{finger="<finger>",name="<container name>",image="<image>"}.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.containers = {}
+        self.body = ""
+
+    def update(self, containers, metrics):
+        """Replace the metrics of the collected containers, dicts with a finger, name and image."""
+        collected = {}
+        for container in containers:
+            labels = 'finger="%s",name="%s",image="%s"' % tuple(
+                _escape(container.get(key) or "") for key in ("finger", "name", "image"))
+            collected[container.get("finger")] = (labels, {})
+
+        for path, value in metrics.iteritems():
+            # ex: the swap percent is None on hosts without swap
+            if not isinstance(value, (int, float)):
+                continue
+
+            finger, _, metric = path.partition(".")
+            if finger in collected:
+                collected[finger][1][metric] = value
+
+        with self.lock:
+            self.containers.update(collected)
+
+    def prune(self, fingers):
+        fingers = set(fingers)
+        with self.lock:
+            for finger in self.containers.keys():
+                if finger not in fingers:
+                    del self.containers[finger]
+
+    def render(self):
+        series = {}
+
+        with self.lock:
+            for labels, metrics in self.containers.itervalues():
+                for metric, value in metrics.iteritems():
+                    name = PREFIX + name_pattern.sub("_", metric)
+                    series.setdefault(name, []).append("%s{%s} %r\n" % (name, labels, float(value)))
+
+        lines = []
+        for name in sorted(series):
+            lines.append("# TYPE %s gauge\n" % name)
+            lines.extend(series[name])
+
+        # replaced at once, the http threads always serve a whole body
+        self.body = "".join(lines)
+
+    def get_body(self):
+        return self.body
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("REGISTRY")
+
+REGISTRY_PATH = "/opt/dataloop/agents.json"
+
+
+class AgentRegistry(object):
+    """Fingers of the agents registered from this host, persisted to a json file.
+
+    The file maps each finger to the time it was registered, it is written again,
+    atomically, only when the registry changed.
+    """
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self.agents = self._load()
+
+    def fingers(self):
+        return set(self.agents)
+
+    def add(self, fingers):
+        now = int(time.time())
+        added = [finger for finger in fingers if finger not in self.agents]
+
+        for finger in added:
+            self.agents[finger] = now
+
+        if added:
+            self._save()
+
+    def remove(self, fingers):
+        removed = [finger for finger in fingers if finger in self.agents]
+
+        for finger in removed:
+            del self.agents[finger]
+
+        if removed:
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except IOError:
+            return {}
+        except ValueError as ex:
+            logger.warn("ignoring corrupt registry %s: %s" % (self.path, ex))
+            return {}
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            with open(tmp_path, "w") as fp:
+                json.dump(self.agents, fp)
+            os.rename(tmp_path, self.path)
+        except EnvironmentError as ex:
+            logger.error("failed to save registry %s: %s" % (self.path, ex))
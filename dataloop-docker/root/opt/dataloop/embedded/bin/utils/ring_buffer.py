@@ -0,0 +1,33 @@
+import math
+from array import array
+
+
+class RingBuffer(object):
+    """Fixed size buffer of floats, the oldest values are overwritten once it is full."""
+
+    __slots__ = ("values", "size", "index")
+
+    def __init__(self, capacity):
+        self.values = array("d", [0.0]) * capacity
+        self.size = 0
+        self.index = 0
+
+    def append(self, value):
+        self.values[self.index] = value
+        self.index = (self.index + 1) % len(self.values)
+        self.size = min(self.size + 1, len(self.values))
+
+    def clear(self):
+        self.size = 0
+        self.index = 0
+
+    def get_aggregates(self):
+        """Return (avg, min, max, p95) of the buffered values, None when empty."""
+        if not self.size:
+            return None
+
+        values = sorted(self.values[:self.size])
+        # nearest rank percentile
+        p95 = values[int(math.ceil(0.95 * self.size)) - 1]
+
+        return sum(values) / self.size, values[0], values[-1], p95
@@ -0,0 +1,65 @@
+import logging
+import threading
+import time
+
+import profiler
+
+logger = logging.getLogger("SCHEDULER")
+
+
+class Scheduler(object):
+    """Run periodic tasks one after the other from a single thread.
+
+    Each task keeps its own fixed cadence, whatever the time spent running it or
+    the other tasks. A task which overran its interval is run again right away.
+
+    With `profile_cycles`, the first runs of each task are profiled.
+    """
+
+    def __init__(self, instruments=None, profile_cycles=0):
+        self.tasks = []
+        self.instruments = instruments
+        self.profile_cycles = profile_cycles
+        self.thread = None
+
+    def add(self, name, interval, task, *args):
+        if self.profile_cycles:
+            task = profiler.profile(name, task, self.profile_cycles)
+
+        self.tasks.append({
+            "name": name,
+            "interval": interval,
+            "run": task,
+            "args": args,
+            "next_run": time.time(),
+        })
+
+    def start(self, name):
+        """Run the tasks from a daemon thread."""
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.run_pending()
+
+            next_run = min(task["next_run"] for task in self.tasks)
+            delay = next_run - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def run_pending(self):
+        for task in sorted(self.tasks, key=lambda t: t["next_run"]):
+            if task["next_run"] > time.time():
+                continue
+
+            task["run"](*task["args"])
+
+            task["next_run"] += task["interval"]
+            now = time.time()
+            if task["next_run"] < now:
+                logger.warn("%s overran the %ss interval" % (task["name"], task["interval"]))
+                if self.instruments:
+                    self.instruments.incr(task["name"] + ".overruns")
+                task["next_run"] = now
@@ -0,0 +1,174 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("SPOOL")
+
+SEGMENT_SIZE = 1024 * 1024          # 1MB per segment file
+MAX_SIZE = 100 * 1024 * 1024        # 100MB for the whole spool
+MAX_AGE = 24 * 60 * 60              # drop what couldn't be sent after a day
+DRAIN_RATE = 5000                   # datapoints per second
+POLL_INTERVAL = 5
+
+SEGMENT_SUFFIX = ".spool"
+
+
+class Spool(object):
+    """Append-only on disk spool for the datapoints graphite couldn't receive.
+
+    Datapoints are appended, with their timestamp, to segment files of at most
+    `segment_size` bytes. The oldest segments are dropped when the spool grows over
+    `max_size` bytes or when they are older than `max_age` seconds. Once started, a
+    background thread sends the segments back, oldest first, at `rate` datapoints
+    per second whenever graphite is reachable. The lines which can't be parsed, ex:
+    a write cut short, are skipped and counted in `skipped`.
+    """
+
+    def __init__(self, path, sender, segment_size=SEGMENT_SIZE, max_size=MAX_SIZE, max_age=MAX_AGE,
+                 rate=DRAIN_RATE):
+        self.path = path
+        self.sender = sender
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.segment = None
+        self.sequence = 0
+        self.skipped = 0
+        self.thread = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._drain, name="spool-drain")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, datapoints):
+        """Append a list of (path, value, timestamp) datapoints."""
+        data = "".join("%s %s %d\n" % datapoint for datapoint in datapoints)
+
+        with self.lock:
+            try:
+                if not self.segment or os.path.getsize(self.segment) >= self.segment_size:
+                    self.segment = self._new_segment()
+
+                with open(self.segment, "a") as fp:
+                    fp.write(data)
+
+                self._expire()
+
+            except (IOError, OSError) as ex:
+                logger.error("can't spool %d datapoints in %s: %s" % (len(datapoints), self.path, ex))
+                # the write may have left a partial line, the next datapoints must not be appended to it
+                self.segment = None
+
+    def _new_segment(self):
+        self.sequence += 1
+        name = "%013d-%06d%s" % (time.time() * 1000, self.sequence % 1000000, SEGMENT_SUFFIX)
+        return os.path.join(self.path, name)
+
+    def _list_segments(self):
+        names = sorted(n for n in os.listdir(self.path) if n.endswith(SEGMENT_SUFFIX))
+        return [os.path.join(self.path, n) for n in names]
+
+    def _expire(self):
+        """Remove the oldest segments until the spool is within its size and age limits."""
+        segments = self._list_segments()
+        sizes = dict((s, os.path.getsize(s)) for s in segments)
+        total_size = sum(sizes.values())
+        min_mtime = time.time() - self.max_age
+
+        for segment in segments:
+            if total_size <= self.max_size and os.path.getmtime(segment) >= min_mtime:
+                break
+
+            logger.warn("dropping spooled segment %s" % segment)
+            os.remove(segment)
+            total_size -= sizes[segment]
+
+            if segment == self.segment:
+                self.segment = None
+
+    def _next_segment(self):
+        with self.lock:
+            self._expire()
+            segments = self._list_segments()
+
+            if not segments:
+                return None
+
+            # stop appending to the segment which is about to be sent
+            if segments[0] == self.segment:
+                self.segment = None
+
+            return segments[0]
+
+    def _drain(self):
+        while True:
+            try:
+                segment = self._next_segment()
+                if segment and self._send_segment(segment):
+                    continue
+
+            except Exception as ex:
+                logger.error("spool drain failed: %s" % ex, exc_info=True)
+
+            time.sleep(POLL_INTERVAL)
+
+    def _send_segment(self, segment):
+        """Send a segment at the configured rate, return False if graphite is still unavailable."""
+        with open(segment) as fp:
+            lines = fp.read().splitlines()
+
+        datapoints = [_parse_line(line) for line in lines]
+        skipped = datapoints.count(None)
+        if skipped:
+            logger.warn("skipping %d malformed lines in %s" % (skipped, segment))
+            self.skipped += skipped
+            lines = [line for line, datapoint in zip(lines, datapoints) if datapoint]
+            datapoints = filter(None, datapoints)
+
+        logger.info("sending %d spooled datapoints from %s" % (len(lines), segment))
+
+        for i in xrange(0, len(lines), self.rate):
+            started = time.time()
+
+            try:
+                self.sender.send(datapoints[i:i + self.rate])
+
+            except EnvironmentError as ex:
+                logger.debug("graphite still unavailable: %s" % ex)
+                # nothing was sent and nothing was skipped, the segment is left as it is
+                if i or skipped:
+                    self._rewrite_segment(segment, lines[i:])
+                return False
+
+            time.sleep(max(0, 1 - (time.time() - started)))
+
+        os.remove(segment)
+        return True
+
+    def _rewrite_segment(self, segment, lines):
+        """Only keep the lines which weren't sent, the segment keeps its place in the queue."""
+        segment_stat = os.stat(segment)
+        tmp_path = segment + ".tmp"
+
+        with open(tmp_path, "w") as fp:
+            fp.write("".join(line + "\n" for line in lines))
+
+        # keep the original mtime so the age limit still applies
+        os.utime(tmp_path, (segment_stat.st_atime, segment_stat.st_mtime))
+        os.rename(tmp_path, segment)
+
+
+def _parse_line(line):
+    """Return (path, value, timestamp), or None if the line is malformed."""
+    try:
+        path, value, timestamp = line.split(" ")
+        return path, float(value), int(timestamp)
+    except ValueError:
+        return None
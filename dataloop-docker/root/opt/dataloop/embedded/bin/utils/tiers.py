@@ -0,0 +1,64 @@
+import fnmatch
+import time
+
+from fractions import gcd
+
+
+class Tiers(object):
+    """Assign the containers to collection tiers, each with its own interval.
+
+    A tier is an (interval, pattern) pair, a container belongs to the first tier whose
+    fnmatch pattern matches its image or one of its labels, else to the default tier.
+    The collection runs every `tick` seconds, the greatest common divisor of the intervals,
+    and only reads the containers of the tiers which are due.
+    """
+
+    def __init__(self, default_interval, tiers=()):
+        self.default_interval = default_interval
+        self.tiers = list(tiers)
+        self.intervals = dict((interval, 0) for interval, _ in self.tiers)
+        self.intervals[default_interval] = 0
+        self.tick = reduce(gcd, self.intervals)
+        self.assigned = {}
+
+    def get_interval(self, container_id, image, labels):
+        """Return the interval of the container tier, it is only matched once per container."""
+        interval = self.assigned.get(container_id)
+
+        if interval is None:
+            interval = self.default_interval
+            for tier_interval, pattern in self.tiers:
+                if any(fnmatch.fnmatchcase(value, pattern) for value in [image] + labels):
+                    interval = tier_interval
+                    break
+
+            self.assigned[container_id] = interval
+
+        return interval
+
+    def get_due(self):
+        """Return the set of the intervals due now, they won't be due again before their next run."""
+        now = time.time()
+        due = set()
+
+        for interval, next_run in self.intervals.items():
+            # a little early is still due, the tick wakes up at about the same time
+            if next_run - now < self.tick / 2.0:
+                due.add(interval)
+                self.intervals[interval] = next_run + interval
+                if self.intervals[interval] <= now:
+                    self.intervals[interval] = now + interval
+
+        return due
+
+    def prune(self, container_ids):
+        container_ids = set(container_ids)
+        for container_id in self.assigned.keys():
+            if container_id not in container_ids:
+                del self.assigned[container_id]
+
+
+def parse_tier(tier):
+    """Parse <interval>:<pattern>, ex: 5:redis*"""
+    interval, pattern = tier.split(":", 1)
+    return int(interval), pattern